@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for expand_variations.py.
+
+Generates a deterministic synthetic repertoire (chapters of random legal
+lines with a controlled branching factor, depth and density of move-order
+transpositions), runs the expansion variants against it and records the
+time of the parse, expand and write stages, lines/s and peak memory per
+variant. Results can be saved and compared against a stored baseline.
+
+Examples:
+    python bench_expand_variations.py --chapters 400 --results bench.json
+    python bench_expand_variations.py --chapters 400 --baseline bench.json --fail-under 0.9
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import chess
+import chess.pgn
+
+import expand_variations
+
+
+def _random_move(rng, board, exclude=()):
+    moves = [move for move in board.legal_moves if move not in exclude]
+    return rng.choice(moves) if moves else None
+
+
+def _transposition(board, line):
+    """
+    Swap the first and third moves of `line` (same side to move) if that
+    reaches the same position. Returns the swapped moves or None.
+    """
+    if len(line) < 3:
+        return None
+    swapped = [line[2], line[1], line[0]]
+    target = board.copy(stack=False)
+    for move in line[:3]:
+        target.push(move)
+    test = board.copy(stack=False)
+    for move in swapped:
+        if not test.is_legal(move):
+            return None
+        test.push(move)
+    return swapped if test.board_fen() == target.board_fen() and test.turn == target.turn else None
+
+
+def _grow(rng, node, board, plies, branching, branch_every, transpositions, ply=0):
+    """Add a line of `plies` moves below `node`, branching every `branch_every` plies."""
+    # Choose the whole line first, so sidelines can transpose back into it
+    line = []
+    test = board.copy(stack=False)
+    for _ in range(plies):
+        move = _random_move(rng, test)
+        if move is None:
+            break
+        line.append(move)
+        test.push(move)
+
+    for i, move in enumerate(line):
+        child = node.add_variation(move)
+        if (ply + i) % branch_every == branch_every - 1:
+            used = {move}
+            for _ in range(branching - 1):
+                swapped = _transposition(board, line[i:]) if rng.random() < transpositions else None
+                if swapped and swapped[0] not in used:
+                    # Short sideline ending in a position of the main line
+                    used.add(swapped[0])
+                    side = node
+                    for side_move in swapped:
+                        side = side.add_variation(side_move)
+                    continue
+                alternative = _random_move(rng, board, used)
+                if alternative is None:
+                    break
+                used.add(alternative)
+                side = node.add_variation(alternative)
+                side_board = board.copy(stack=False)
+                side_board.push(alternative)
+                _grow(rng, side, side_board, len(line) - i - 1, branching, branch_every, transpositions,
+                      ply + i + 1)
+        board = board.copy(stack=False)
+        board.push(move)
+        node = child
+
+
+def generate_repertoire(path, chapters, depth=16, branching=3, branch_every=4, transpositions=0.2, seed=1):
+    """
+    Write a deterministic synthetic repertoire. Returns its size in bytes.
+
+    Every chapter is a tree of lines `depth` plies long. Every
+    `branch_every` plies each line branches into `branching` moves; a
+    `transpositions` fraction of the extra moves are move-order swaps that
+    end in a position already on the line they branch from.
+    """
+    rng = random.Random(seed)
+    with open(path, "w", encoding="utf-8", newline="\n") as f:
+        for i in range(chapters):
+            game = chess.pgn.Game()
+            game.headers["Event"] = f"Repertoire: Chapter {i + 1}"
+            game.headers["Site"] = "https://lichess.org/study/bench"
+            game.headers["Annotator"] = "bench"
+            _grow(rng, game, game.board(), depth, branching, branch_every, transpositions)
+            # A few comments and NAGs, as in real studies
+            for node in list(game.mainline())[::5]:
+                node.comment = f"Idea {rng.randint(1, 99)}"
+                node.nags.add(rng.choice([1, 2, 3, 5, 6]))
+            print(game, file=f, end="\n\n")
+    return os.path.getsize(path)
+
+
+# --- Variants -----------------------------------------------------------------
+# Each takes (pgn_path, work_dir) and returns (lines written, {stage: seconds}).
+
+def _timed(stages, name, started):
+    now = time.perf_counter()
+    stages[name] = stages.get(name, 0) + now - started
+    return now
+
+
+def variant_stages(pgn_path, work_dir):
+    stages = {}
+    started = time.perf_counter()
+    with open(pgn_path, "r", encoding="utf-8") as f:
+        games = list(iter(lambda: expand_variations.read_tree_game(f), None))
+    started = _timed(stages, "parse", started)
+
+    expanded = [(game, [list(path) for path in expand_variations.iter_paths(game.tree, game.root)])
+                for game in games]
+    started = _timed(stages, "expand", started)
+
+    with open(os.path.join(work_dir, "stages.pgn"), "w", encoding="utf-8",
+              buffering=expand_variations.WRITE_BUFFER_SIZE) as out_file:
+        lines = 0
+        for game, paths in expanded:
+            writer = expand_variations.LineWriter(out_file, game.tree)
+            for path in paths:
+                writer.write(game, path)
+            lines += len(paths)
+    _timed(stages, "write", started)
+    return lines, stages
+
+
+def variant_stages_repertoire(pgn_path, work_dir):
+    stages = {}
+    started = time.perf_counter()
+    tree = expand_variations.MoveTree()
+    with open(pgn_path, "r", encoding="utf-8") as f:
+        while expand_variations.read_tree_game(f, tree) is not None:
+            pass
+    started = _timed(stages, "parse", started)
+
+    graph = expand_variations.TranspositionGraph(tree)
+    seen = set()
+    expanded = []
+    for game in tree.games:
+        for path in expand_variations.iter_paths(tree, game.root, graph=graph):
+            digest = expand_variations.line_digest(game, path)
+            if digest not in seen:
+                seen.add(digest)
+                expanded.append((game, list(path)))
+    started = _timed(stages, "expand", started)
+
+    with open(os.path.join(work_dir, "stages_repertoire.pgn"), "w", encoding="utf-8",
+              buffering=expand_variations.WRITE_BUFFER_SIZE) as out_file:
+        writer = expand_variations.LineWriter(out_file, tree)
+        for game, path in expanded:
+            writer.write(game, path)
+    _timed(stages, "write", started)
+    return len(expanded), stages
+
+
+def variant_objects(pgn_path, work_dir):
+    """The chess.pgn object API: extract_all_paths() and create_game_from_path()."""
+    stages = {}
+    started = time.perf_counter()
+    with open(pgn_path, "r", encoding="utf-8") as f:
+        games = list(iter(lambda: chess.pgn.read_game(f), None))
+    started = _timed(stages, "parse", started)
+
+    expanded = [(game, expand_variations.extract_all_paths(game, game, [])) for game in games]
+    started = _timed(stages, "expand", started)
+
+    lines = 0
+    with open(os.path.join(work_dir, "objects.pgn"), "w", encoding="utf-8") as out_file:
+        for game, paths in expanded:
+            for path in paths:
+                print(expand_variations.create_game_from_path(game, path), file=out_file, end="\n\n")
+            lines += len(paths)
+    _timed(stages, "write", started)
+    return lines, stages
+
+
+def _end_to_end(**kwargs):
+    def variant(pgn_path, work_dir):
+        output = os.path.join(work_dir, "end_to_end.pgn")
+        return expand_variations.expand_variations(pgn_path, output, **kwargs), {}
+    return variant
+
+
+def variant_expand_prune(pgn_path, work_dir):
+    # Fresh stats per run, so repeats don't count each other's pruned lines
+    return _end_to_end(prune=expand_variations.PruneStats())(pgn_path, work_dir)
+
+
+def variant_dry_run(pgn_path, work_dir):
+    return sum(lines for _, lines in expand_variations.count_expanded_lines(pgn_path)), {}
+
+
+VARIANTS = {
+    "stages": variant_stages,
+    "stages_repertoire": variant_stages_repertoire,
+    "objects": variant_objects,
+    "expand": _end_to_end(),
+    "expand_repertoire": _end_to_end(repertoire=True),
+    "expand_prune": variant_expand_prune,
+    "expand_jobs4": _end_to_end(jobs=4),
+    "dry_run": variant_dry_run,
+}
+
+
+def _peak_memory(variant, pgn_path, work_dir):
+    """Peak traced Python allocation of one run, in MB (this process only)."""
+    tracemalloc.start()
+    try:
+        variant(pgn_path, work_dir)
+        return tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+
+def run_benchmarks(pgn_path, variants, repeat=3, memory=True):
+    """Time each variant (best of `repeat` runs) and return {name: result dict}."""
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="bench_expand_variations_") as work_dir:
+        for name in variants:
+            best = None
+            best_stages = {}
+            lines = 0
+            for _ in range(repeat):
+                started = time.perf_counter()
+                lines, stages = VARIANTS[name](pgn_path, work_dir)
+                elapsed = time.perf_counter() - started
+                if best is None or elapsed < best:
+                    best, best_stages = elapsed, stages
+            results[name] = {
+                "seconds": round(best, 4),
+                "lines": lines,
+                "lines_per_s": round(lines / best, 1),
+                "stages": {stage: round(seconds, 4) for stage, seconds in best_stages.items()},
+            }
+            # Measured separately: tracing slows the run down
+            if memory:
+                results[name]["peak_mb"] = round(_peak_memory(VARIANTS[name], pgn_path, work_dir), 1)
+
+            stages = "  ".join(f"{stage} {seconds:.2f}s" for stage, seconds in best_stages.items())
+            peak = f"{results[name]['peak_mb']:>8.1f} MB" if memory else ""
+            print(f"  {name:<18} {results[name]['lines_per_s']:>10.0f} lines/s {peak}  {stages}")
+    return results
+
+
+def compare(results, baseline):
+    """Print lines/s ratios against a baseline. Returns {variant: ratio}."""
+    ratios = {}
+    print("\nCompared with baseline (lines/s, >1.00 is faster):")
+    for name, result in results.items():
+        base = baseline.get("variants", {}).get(name)
+        if not base:
+            print(f"  {name:<18}   (not in baseline)")
+            continue
+        ratio = result["lines_per_s"] / base["lines_per_s"]
+        ratios[name] = ratio
+        memory = ""
+        if "peak_mb" in result and "peak_mb" in base:
+            memory = f", peak {base['peak_mb']:.1f} -> {result['peak_mb']:.1f} MB"
+        print(f"  {name:<18} {ratio:6.2f}x  ({base['lines_per_s']:.0f} -> {result['lines_per_s']:.0f}{memory})")
+    return ratios
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark expand_variations.py on a synthetic repertoire.",
+        epilog="Example: python bench_expand_variations.py --chapters 400 --results bench.json",
+    )
+    parser.add_argument("--chapters", type=int, default=200, help="Chapters in the synthetic repertoire")
+    parser.add_argument("--depth", type=int, default=16, help="Plies in every line")
+    parser.add_argument("--branching", type=int, default=3, help="Moves at each branch point")
+    parser.add_argument("--branch-every", type=int, default=4, help="Plies between branch points")
+    parser.add_argument("--transpositions", type=float, default=0.2,
+                        help="Fraction of sidelines that are move-order transpositions")
+    parser.add_argument("--seed", type=int, default=1, help="Repertoire random seed")
+    parser.add_argument("--corpus", help="Repertoire path (generated if missing; default: temp dir, cached by parameters)")
+    parser.add_argument("--variants", help=f"Comma-separated subset of: {', '.join(VARIANTS)}")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per variant; the best is kept")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the peak memory measurement runs")
+    parser.add_argument("--results", help="Write results JSON here")
+    parser.add_argument("--baseline", help="Compare against a previously saved results JSON")
+    parser.add_argument("--fail-under", type=float, metavar="RATIO",
+                        help="Exit with status 1 if any variant is slower than RATIO x baseline")
+    args = parser.parse_args()
+
+    variants = [v.strip() for v in args.variants.split(",")] if args.variants else list(VARIANTS)
+    unknown = [v for v in variants if v not in VARIANTS]
+    if unknown:
+        print(f"Error: unknown variants: {', '.join(unknown)}")
+        return 1
+
+    corpus_params = {
+        "chapters": args.chapters, "depth": args.depth, "branching": args.branching,
+        "branch_every": args.branch_every, "transpositions": args.transpositions, "seed": args.seed,
+    }
+    corpus = args.corpus or os.path.join(
+        tempfile.gettempdir(), "bench_repertoire_" + "_".join(str(v) for v in corpus_params.values()) + ".pgn")
+    if not os.path.exists(corpus):
+        print(f"Generating {args.chapters} chapters into {corpus}...")
+        generate_repertoire(corpus, **corpus_params)
+    size = os.path.getsize(corpus)
+    print(f"Repertoire: {corpus} ({size / 1e6:.1f} MB)\n")
+
+    results = run_benchmarks(corpus, variants, args.repeat, not args.no_memory)
+    report = {
+        "corpus": dict(corpus_params, bytes=size),
+        "python": platform.python_version(),
+        "chess": chess.__version__,
+        "platform": platform.platform(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "variants": results,
+    }
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("corpus") != report["corpus"]:
+            print("\nWarning: baseline was recorded on a different repertoire")
+        ratios = compare(results, baseline)
+        if args.fail_under is not None:
+            slow = [name for name, ratio in ratios.items() if ratio < args.fail_under]
+            if slow:
+                print(f"\nRegression: {', '.join(slow)} below {args.fail_under:.2f}x baseline")
+                status = 1
+
+    if args.results:
+        with open(args.results, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved results to {args.results}")
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for filter_games.py.
+
+Generates a deterministic synthetic PGN corpus (lichess-like headers, Elo,
+time control and result distributions, realistic movetext with clock
+comments), runs the scanning and filtering variants against it and records
+games/s and MB/s per variant. Results can be saved and compared against a
+stored baseline.
+
+Examples:
+    python bench_filter_games.py --games 200000 --results bench.json
+    python bench_filter_games.py --games 200000 --baseline bench.json --fail-under 0.9
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+import filter_games
+
+# Relative frequencies, roughly as in a lichess monthly dump
+TIME_CONTROLS = [
+    ("60+0", 18), ("120+1", 6), ("180+0", 20), ("180+2", 10), ("300+0", 14), ("300+3", 8),
+    ("600+0", 12), ("600+5", 5), ("900+10", 4), ("1800+0", 2), ("-", 1),
+]
+RESULTS = [("1-0", 49), ("0-1", 45), ("1/2-1/2", 6)]
+TERMINATIONS = [("Normal", 70), ("Time forfeit", 29), ("Abandoned", 1)]
+
+# Used when python-chess is not installed: legal opening lines, extended with
+# plausible (not necessarily legal) SAN so game lengths stay realistic
+FALLBACK_LINES = [
+    "e4 c5 Nf3 d6 d4 cxd4 Nxd4 Nf6 Nc3 a6 Be3 e5 Nb3 Be6 f3 Be7 Qd2 O-O O-O-O Nbd7",
+    "e4 e5 Nf3 Nc6 Bb5 a6 Ba4 Nf6 O-O Be7 Re1 b5 Bb3 d6 c3 O-O h3 Nb8 d4 Nbd7",
+    "d4 Nf6 c4 e6 Nc3 Bb4 e3 O-O Bd3 d5 Nf3 c5 O-O Nc6 a3 Bxc3 bxc3 dxc4 Bxc4 Qc7",
+    "d4 d5 c4 c6 Nf3 Nf6 Nc3 dxc4 a4 Bf5 e3 e6 Bxc4 Bb4 O-O O-O Qe2 Nbd7 e4 Bg6",
+    "e4 e6 d4 d5 Nc3 Nf6 Bg5 Be7 e5 Nfd7 Bxe7 Qxe7 f4 O-O Nf3 c5 Qd2 Nc6 O-O-O c4",
+    "c4 e5 Nc3 Nf6 Nf3 Nc6 g3 d5 cxd5 Nxd5 Bg2 Nb6 O-O Be7 d3 O-O a3 Be6 b4 a5",
+]
+FILLER_MOVES = ["Rfe1", "Rad8", "h3", "h6", "Kh1", "Kh8", "Qe2", "Qc7", "a4", "a5", "Rc1", "Rc8",
+                "Nd2", "Nd7", "g3", "g6", "Kg2", "Kg7", "Bf1", "Bf8", "Rb1", "Rb8", "Qd3", "Qd6"]
+
+
+def _weighted(rng, table):
+    return rng.choices([value for value, _ in table], weights=[weight for _, weight in table])[0]
+
+
+def _move_pool(rng, size=256):
+    """Mainline SAN sequences to draw movetext from (legal when python-chess is available)."""
+    try:
+        import chess
+    except ImportError:
+        pool = []
+        for i in range(size):
+            line = FALLBACK_LINES[i % len(FALLBACK_LINES)].split()
+            pool.append(line + [rng.choice(FILLER_MOVES) for _ in range(rng.randint(20, 100))])
+        return pool
+
+    pool = []
+    for _ in range(size):
+        board = chess.Board()
+        sans = []
+        for _ in range(rng.randint(20, 140)):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            move = rng.choice(moves)
+            sans.append(board.san(move))
+            board.push(move)
+        pool.append(sans)
+    return pool
+
+
+def _clock(seconds):
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+def generate_corpus(path, games, seed=1):
+    """Write a deterministic synthetic PGN with `games` games. Returns its size in bytes."""
+    rng = random.Random(seed)
+    pool = _move_pool(rng)
+    players = [f"player_{i:05d}" for i in range(max(games // 20, 50))]
+    openings = [line.split("\t") for line in filter_games.BUILTIN_ECO_TABLE.splitlines()]
+
+    with open(path, "w", encoding="utf-8", newline="\n") as f:
+        for i in range(games):
+            white, black = rng.sample(players, 2)
+            white_elo = min(max(int(rng.gauss(1600, 350)), 600), 3200)
+            black_elo = min(max(int(white_elo + rng.gauss(0, 180)), 600), 3200)
+            time_control = _weighted(rng, TIME_CONTROLS)
+            result = _weighted(rng, RESULTS)
+            eco, opening, _ = rng.choice(openings)
+            year = rng.randint(2015, 2024)
+            headers = [
+                ("Event", f"Rated {filter_games.time_control_speed(time_control) or 'correspondence'} game"),
+                ("Site", f"https://lichess.org/{rng.getrandbits(40):010x}"),
+                ("Date", f"{year}.{rng.randint(1, 12):02d}.{rng.randint(1, 28):02d}"),
+                ("Round", "-"),
+                ("White", white),
+                ("Black", black),
+                ("Result", result),
+                ("WhiteElo", str(white_elo) if rng.random() > 0.01 else "?"),
+                ("BlackElo", str(black_elo) if rng.random() > 0.01 else "?"),
+                ("TimeControl", time_control),
+                ("ECO", eco),
+                ("Opening", opening),
+                ("Termination", _weighted(rng, TERMINATIONS)),
+            ]
+            for tag, value in headers:
+                f.write(f'[{tag} "{value}"]\n')
+            f.write("\n")
+
+            sans = rng.choice(pool)
+            base = int(time_control.split("+")[0]) if time_control[0].isdigit() else 0
+            with_clock = base and rng.random() < 0.5
+            tokens = []
+            for ply, san in enumerate(sans):
+                if ply % 2 == 0:
+                    tokens.append(f"{ply // 2 + 1}.")
+                elif with_clock:
+                    tokens.append(f"{ply // 2 + 1}...")
+                tokens.append(san)
+                if with_clock:
+                    tokens.append(f"{{ [%clk {_clock(max(base - ply * 2, 0))}] }}")
+            tokens.append(result)
+
+            line_len = 0
+            for token in tokens:
+                if line_len + len(token) > 79:
+                    f.write("\n")
+                    line_len = 0
+                elif line_len:
+                    f.write(" ")
+                    line_len += 1
+                f.write(token)
+                line_len += len(token)
+            f.write("\n\n")
+    return os.path.getsize(path)
+
+
+# --- Variants -----------------------------------------------------------------
+# Each takes (pgn_path, work_dir) and returns the number of games processed.
+
+DEFAULT_CRITERIA = {"min_diff": 200, "elo_range": [1650, 1850]}
+
+MULTI_SPECS = [
+    {"name": "diff200_club", "min_diff": 200, "elo_range": [1650, 1850]},
+    {"name": "diff400_blitz", "min_diff": 400, "speed": "blitz"},
+    {"name": "upsets", "min_diff": 300, "outcome": "weaker_wins_or_draws"},
+    {"name": "classical_2000", "min_elo": 2000, "speed": ["rapid", "classical"]},
+    {"name": "sicilian_eco", "eco": "B20-B99"},
+    {"name": "recent", "date_from": "2023.01.01"},
+    {"name": "draws", "result": "1/2-1/2"},
+    {"name": "strong_wins", "min_diff": 100, "outcome": "stronger_wins"},
+]
+
+
+def _quiet_metrics():
+    return filter_games.ScanMetrics(interval=float("inf"))
+
+
+def variant_stream_games(pgn_path, work_dir):
+    return sum(1 for _ in filter_games.stream_games(pgn_path))
+
+
+def variant_scan_games(pgn_path, work_dir):
+    return sum(1 for _ in filter_games.scan_games(pgn_path))
+
+
+def variant_scan_parse(pgn_path, work_dir):
+    count = 0
+    for _, _, raw_lines in filter_games.scan_games(pgn_path):
+        filter_games.GameInfo(filter_games.parse_raw_headers(raw_lines))
+        count += 1
+    return count
+
+
+def _run_specs(pgn_path, work_dir, specs, **kwargs):
+    specs = [dict(spec, output=os.path.join(work_dir, spec["name"] + ".pgn")) for spec in specs]
+    return filter_games.run_filters(pgn_path, specs, work_dir, metrics=_quiet_metrics(), **kwargs).total
+
+
+def variant_filter_one(pgn_path, work_dir):
+    return _run_specs(pgn_path, work_dir, [dict(DEFAULT_CRITERIA, name="all")])
+
+
+def variant_filter_split(pgn_path, work_dir):
+    return _run_specs(pgn_path, work_dir, [
+        dict(DEFAULT_CRITERIA, name="all"),
+        dict(DEFAULT_CRITERIA, name="strong", outcome="stronger_wins"),
+        dict(DEFAULT_CRITERIA, name="weak", outcome="weaker_wins_or_draws"),
+    ])
+
+
+def variant_filter_multi(pgn_path, work_dir):
+    return _run_specs(pgn_path, work_dir, MULTI_SPECS)
+
+
+def variant_filter_opening(pgn_path, work_dir):
+    return _run_specs(pgn_path, work_dir, [{"name": "sicilian", "opening": "Sicilian Defense", "min_diff": 200}])
+
+
+def variant_filter_sample(pgn_path, work_dir):
+    return _run_specs(pgn_path, work_dir, [dict(DEFAULT_CRITERIA, name="sample", sample=1000)], seed=1)
+
+
+def variant_dedupe(pgn_path, work_dir):
+    games = sum(1 for _ in filter_games.scan_games(pgn_path))
+    dedupe = filter_games.GameDeduplicator(work_dir, games, memory_mb=16)
+    try:
+        return _run_specs(pgn_path, work_dir, [{"name": "unique"}], dedupe=dedupe)
+    finally:
+        dedupe.close()
+
+
+VARIANTS = {
+    "stream_games": variant_stream_games,
+    "scan_games": variant_scan_games,
+    "scan_parse": variant_scan_parse,
+    "filter_one": variant_filter_one,
+    "filter_split": variant_filter_split,
+    "filter_multi8": variant_filter_multi,
+    "filter_opening": variant_filter_opening,
+    "filter_sample": variant_filter_sample,
+    "dedupe": variant_dedupe,
+}
+
+
+def run_benchmarks(pgn_path, variants, repeat=3):
+    """Time each variant (best of `repeat` runs) and return {name: result dict}."""
+    size = os.path.getsize(pgn_path)
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="bench_filter_games_") as work_dir:
+        for name in variants:
+            best = None
+            games = 0
+            for _ in range(repeat):
+                started = time.perf_counter()
+                games = VARIANTS[name](pgn_path, work_dir)
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            results[name] = {
+                "seconds": round(best, 4),
+                "games": games,
+                "games_per_s": round(games / best, 1),
+                "mb_per_s": round(size / best / 1e6, 2),
+            }
+            print(f"  {name:<16} {results[name]['games_per_s']:>12.0f} games/s "
+                  f"{results[name]['mb_per_s']:>8.2f} MB/s")
+    return results
+
+
+def compare(results, baseline):
+    """Print games/s ratios against a baseline. Returns {variant: ratio}."""
+    ratios = {}
+    print("\nCompared with baseline (games/s, >1.00 is faster):")
+    for name, result in results.items():
+        base = baseline.get("variants", {}).get(name)
+        if not base:
+            print(f"  {name:<16}   (not in baseline)")
+            continue
+        ratio = result["games_per_s"] / base["games_per_s"]
+        ratios[name] = ratio
+        print(f"  {name:<16} {ratio:6.2f}x  ({base['games_per_s']:.0f} -> {result['games_per_s']:.0f})")
+    return ratios
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark filter_games.py on a synthetic PGN corpus.",
+        epilog="Example: python bench_filter_games.py --games 200000 --results bench.json",
+    )
+    parser.add_argument("--games", type=int, default=100000, help="Games in the synthetic corpus")
+    parser.add_argument("--seed", type=int, default=1, help="Corpus random seed")
+    parser.add_argument("--corpus", help="Corpus path (generated if missing; default: temp dir, cached by size/seed)")
+    parser.add_argument("--variants", help=f"Comma-separated subset of: {', '.join(VARIANTS)}")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per variant; the best is kept")
+    parser.add_argument("--results", help="Write results JSON here")
+    parser.add_argument("--baseline", help="Compare against a previously saved results JSON")
+    parser.add_argument("--fail-under", type=float, metavar="RATIO",
+                        help="Exit with status 1 if any variant is slower than RATIO x baseline")
+    args = parser.parse_args()
+
+    variants = [v.strip() for v in args.variants.split(",")] if args.variants else list(VARIANTS)
+    unknown = [v for v in variants if v not in VARIANTS]
+    if unknown:
+        print(f"Error: unknown variants: {', '.join(unknown)}")
+        return 1
+
+    corpus = args.corpus or os.path.join(tempfile.gettempdir(), f"bench_corpus_{args.games}_{args.seed}.pgn")
+    if not os.path.exists(corpus):
+        print(f"Generating {args.games} games into {corpus}...")
+        generate_corpus(corpus, args.games, args.seed)
+    size = os.path.getsize(corpus)
+    print(f"Corpus: {corpus} ({size / 1e6:.1f} MB)\n")
+
+    results = run_benchmarks(corpus, variants, args.repeat)
+    report = {
+        "corpus": {"games": args.games, "seed": args.seed, "bytes": size},
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "variants": results,
+    }
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("corpus") != report["corpus"]:
+            print("\nWarning: baseline was recorded on a different corpus")
+        ratios = compare(results, baseline)
+        if args.fail_under is not None:
+            slow = [name for name, ratio in ratios.items() if ratio < args.fail_under]
+            if slow:
+                print(f"\nRegression: {', '.join(slow)} below {args.fail_under:.2f}x baseline")
+                status = 1
+
+    if args.results:
+        with open(args.results, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nSaved results to {args.results}")
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
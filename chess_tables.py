@@ -0,0 +1,121 @@
+"""
+Precomputed square tables for the chess training drills.
+
+Squares are indexed 0-63 from a1 to h8 (index = rank * 8 + file). Sets of
+squares are bitboards: ints with bit `index` set for each square in the set.
+"""
+
+from collections import deque
+
+FILES = "abcdefgh"
+RANKS = "12345678"
+
+SQUARE_NAMES = [file + rank for rank in RANKS for file in FILES]
+SQUARES = {name: index for index, name in enumerate(SQUARE_NAMES)}
+
+ROOK_DIRECTIONS = [(1, 0), (-1, 0), (0, 1), (0, -1)]
+BISHOP_DIRECTIONS = [(1, 1), (1, -1), (-1, 1), (-1, -1)]
+KNIGHT_OFFSETS = [(-2, -1), (-2, 1), (-1, -2), (-1, 2), (1, -2), (1, 2), (2, -1), (2, 1)]
+
+# Light squares: file + rank (from 0) is odd, so a1 is dark
+LIGHT_SQUARES = sum(1 << index for index in range(64) if (index % 8 + index // 8) % 2)
+
+
+def _walk(square, df, dr):
+    """Squares from `square` (exclusive) to the edge of the board in one direction"""
+    file, rank = square % 8 + df, square // 8 + dr
+    while 0 <= file < 8 and 0 <= rank < 8:
+        yield rank * 8 + file
+        file, rank = file + df, rank + dr
+
+
+def _line_masks(directions):
+    """Squares reachable along `directions` on an empty board, per square"""
+    return [sum(1 << target for df, dr in directions for target in _walk(square, df, dr))
+            for square in range(64)]
+
+
+def _between_masks():
+    """Squares strictly between two squares on a common line (0 if not aligned)"""
+    between = [[0] * 64 for _ in range(64)]
+    for square in range(64):
+        for df, dr in ROOK_DIRECTIONS + BISHOP_DIRECTIONS:
+            mask = 0
+            for target in _walk(square, df, dr):
+                between[square][target] = mask
+                mask |= 1 << target
+    return between
+
+
+def _knight_distances():
+    """Minimum knight moves between every pair of squares (BFS from each square)"""
+    neighbours = [[rank * 8 + file
+                   for df, dr in KNIGHT_OFFSETS
+                   for file, rank in [(square % 8 + df, square // 8 + dr)]
+                   if 0 <= file < 8 and 0 <= rank < 8]
+                  for square in range(64)]
+    distances = []
+    for origin in range(64):
+        distance = [None] * 64
+        distance[origin] = 0
+        queue = deque([origin])
+        while queue:
+            square = queue.popleft()
+            for target in neighbours[square]:
+                if distance[target] is None:
+                    distance[target] = distance[square] + 1
+                    queue.append(target)
+        distances.append(distance)
+    return distances
+
+
+def _bishop_distances():
+    """Minimum bishop moves between every pair of squares (inf on the other colour)"""
+    return [[0 if origin == target
+             else 1 if BISHOP_LINES[origin] >> target & 1
+             else 2 if (LIGHT_SQUARES >> origin & 1) == (LIGHT_SQUARES >> target & 1)
+             else float('inf')
+             for target in range(64)]
+            for origin in range(64)]
+
+
+ROOK_LINES = _line_masks(ROOK_DIRECTIONS)
+BISHOP_LINES = _line_masks(BISHOP_DIRECTIONS)
+QUEEN_LINES = [rook | bishop for rook, bishop in zip(ROOK_LINES, BISHOP_LINES)]
+BETWEEN = _between_masks()
+KNIGHT_DISTANCE = _knight_distances()
+BISHOP_DISTANCE = _bishop_distances()
+
+
+def bitboard(*names):
+    """Bitboard of the named squares"""
+    mask = 0
+    for name in names:
+        mask |= 1 << SQUARES[name]
+    return mask
+
+
+def is_light(square):
+    """Whether a square index is a light square"""
+    return bool(LIGHT_SQUARES >> square & 1)
+
+
+def line_attacks(lines, origin, target, blockers=0):
+    """Whether a slider with `lines` masks on `origin` attacks `target`, past `blockers`"""
+    # The drills have always counted a piece's own square as attacked
+    return origin == target or bool(lines[origin] >> target & 1) and not BETWEEN[origin][target] & blockers
+
+
+def rook_attacks(origin, target, blockers=0):
+    """Whether a rook on `origin` attacks `target`"""
+    return line_attacks(ROOK_LINES, origin, target, blockers)
+
+
+def bishop_attacks(origin, target, blockers=0):
+    """Whether a bishop on `origin` attacks `target`"""
+    return line_attacks(BISHOP_LINES, origin, target, blockers)
+
+
+def queen_attacks(origin, target, blockers=0):
+    """Whether a queen on `origin` attacks `target`"""
+    return line_attacks(QUEEN_LINES, origin, target, blockers)
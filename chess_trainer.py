@@ -3,6 +3,10 @@ from tkinter import messagebox
 import random
 import time
 
+from chess_tables import (
+    BISHOP_DISTANCE, KNIGHT_DISTANCE, SQUARES, bishop_attacks, bitboard, is_light, queen_attacks, rook_attacks
+)
+
 
 class ChessTrainer:
     def __init__(self, root):
@@ -189,11 +193,7 @@ class ChessTrainer:
     
     def get_square_color(self, square):
         """Determine if a square is dark or light"""
-        file_num = ord(square[0]) - ord('a') + 1  # a=1, b=2, etc.
-        rank_num = int(square[1])
-        
-        # If sum is even, square is dark; if odd, square is light
-        return "dark" if (file_num + rank_num) % 2 == 0 else "light"
+        return "light" if is_light(SQUARES[square]) else "dark"
     
     def check_answer(self, answer):
         """Check if the answer is correct"""
@@ -290,20 +290,9 @@ class ChessTrainer:
         self.time_label = tk.Label(self.root, text="", font=("Arial", 10))
         self.time_label.pack(pady=5)
     
-    def is_queen_attacking_square(self, queen_square, target_square):
-        """Check if queen attacks a target square"""
-        q_file, q_rank = ord(queen_square[0]) - ord('a'), int(queen_square[1]) - 1
-        t_file, t_rank = ord(target_square[0]) - ord('a'), int(target_square[1]) - 1
-        
-        # Same file or rank
-        if q_file == t_file or q_rank == t_rank:
-            return True
-        
-        # Diagonal
-        if abs(q_file - t_file) == abs(q_rank - t_rank):
-            return True
-        
-        return False
+    def is_queen_attacking_square(self, queen_square, target_square, blockers=()):
+        """Check if queen attacks a target square, with pieces on the blocker squares in the way"""
+        return queen_attacks(SQUARES[queen_square], SQUARES[target_square], bitboard(*blockers))
     
     def show_new_queen_knight(self):
         """Generate and display new queen and knight positions"""
@@ -382,9 +371,7 @@ class ChessTrainer:
     
     def get_square_color_numeric(self, square):
         """Get numeric square color (0 or 1)"""
-        file_num = ord(square[0]) - ord('a')
-        rank_num = int(square[1]) - 1
-        return (file_num + rank_num) % 2
+        return int(is_light(SQUARES[square]))
     
     def show_new_queen_bishop(self):
         """Generate and display new queen and bishop positions"""
@@ -472,27 +459,13 @@ class ChessTrainer:
         self.time_label = tk.Label(self.root, text="", font=("Arial", 10))
         self.time_label.pack(pady=5)
     
-    def is_rook_attacking_square(self, rook_square, target_square):
-        """Check if rook attacks a target square"""
-        r_file, r_rank = ord(rook_square[0]) - ord('a'), int(rook_square[1]) - 1
-        t_file, t_rank = ord(target_square[0]) - ord('a'), int(target_square[1]) - 1
-        
-        # Same file or rank
-        if r_file == t_file or r_rank == t_rank:
-            return True
-        
-        return False
+    def is_rook_attacking_square(self, rook_square, target_square, blockers=()):
+        """Check if rook attacks a target square, with pieces on the blocker squares in the way"""
+        return rook_attacks(SQUARES[rook_square], SQUARES[target_square], bitboard(*blockers))
     
-    def is_bishop_attacking_square(self, bishop_square, target_square):
-        """Check if bishop attacks a target square"""
-        b_file, b_rank = ord(bishop_square[0]) - ord('a'), int(bishop_square[1]) - 1
-        t_file, t_rank = ord(target_square[0]) - ord('a'), int(target_square[1]) - 1
-        
-        # Diagonal
-        if abs(b_file - t_file) == abs(b_rank - t_rank):
-            return True
-        
-        return False
+    def is_bishop_attacking_square(self, bishop_square, target_square, blockers=()):
+        """Check if bishop attacks a target square, with pieces on the blocker squares in the way"""
+        return bishop_attacks(SQUARES[bishop_square], SQUARES[target_square], bitboard(*blockers))
     
     def show_new_rb_bishop(self):
         """Generate and display new rook+bishop vs bishop positions"""
@@ -521,8 +494,8 @@ class ChessTrainer:
             
             if (white_bishop_square != rook_square and 
                 white_bishop_square != black_bishop_square and
-                not self.is_rook_attacking_square(rook_square, white_bishop_square) and
-                not self.is_bishop_attacking_square(black_bishop_square, white_bishop_square)):
+                not self.is_rook_attacking_square(rook_square, white_bishop_square, [black_bishop_square]) and
+                not self.is_bishop_attacking_square(black_bishop_square, white_bishop_square, [rook_square])):
                 break
         
         # Get white bishop's square color
@@ -621,8 +594,8 @@ class ChessTrainer:
             
             if (white_knight_square != rook_square and 
                 white_knight_square != black_bishop_square and
-                not self.is_rook_attacking_square(rook_square, white_knight_square) and
-                not self.is_bishop_attacking_square(black_bishop_square, white_knight_square)):
+                not self.is_rook_attacking_square(rook_square, white_knight_square, [black_bishop_square]) and
+                not self.is_bishop_attacking_square(black_bishop_square, white_knight_square, [rook_square])):
                 break
         
         # Generate target square (any square, different from all pieces)
@@ -740,60 +713,12 @@ class ChessTrainer:
     
     def calculate_bishop_moves_to_square(self, bishop_pos, target_pos):
         """Calculate minimum moves for bishop to reach target square"""
-        b_file, b_rank = ord(bishop_pos[0]) - ord('a'), int(bishop_pos[1]) - 1
-        t_file, t_rank = ord(target_pos[0]) - ord('a'), int(target_pos[1]) - 1
-        
-        # If already on target
-        if bishop_pos == target_pos:
-            return 0
-        
-        # Check if target is on same diagonal
-        if abs(b_file - t_file) == abs(b_rank - t_rank):
-            return 1
-        
-        # Check if target is same color square as bishop
-        bishop_square_color = (b_file + b_rank) % 2
-        target_square_color = (t_file + t_rank) % 2
-        
-        if bishop_square_color != target_square_color:
-            return float('inf')  # Impossible - different colored squares
-        
-        # Otherwise it takes 2 moves
-        return 2
+        # inf for squares of the other colour
+        return BISHOP_DISTANCE[SQUARES[bishop_pos]][SQUARES[target_pos]]
     
     def calculate_knight_moves_to_square(self, knight_pos, target_pos):
         """Calculate minimum moves for knight to reach target square"""
-        from collections import deque
-        
-        if knight_pos == target_pos:
-            return 0
-        
-        k_file, k_rank = ord(knight_pos[0]) - ord('a'), int(knight_pos[1]) - 1
-        t_file, t_rank = ord(target_pos[0]) - ord('a'), int(target_pos[1]) - 1
-        
-        # BFS to find shortest path
-        knight_moves = [
-            (-2, -1), (-2, 1), (-1, -2), (-1, 2),
-            (1, -2), (1, 2), (2, -1), (2, 1)
-        ]
-        
-        visited = set()
-        queue = deque([(k_file, k_rank, 0)])
-        visited.add((k_file, k_rank))
-        
-        while queue:
-            file, rank, moves = queue.popleft()
-            
-            if file == t_file and rank == t_rank:
-                return moves
-            
-            for df, dr in knight_moves:
-                new_file, new_rank = file + df, rank + dr
-                if 0 <= new_file < 8 and 0 <= new_rank < 8 and (new_file, new_rank) not in visited:
-                    visited.add((new_file, new_rank))
-                    queue.append((new_file, new_rank, moves + 1))
-        
-        return float('inf')
+        return KNIGHT_DISTANCE[SQUARES[knight_pos]][SQUARES[target_pos]]
     
     def can_piece_catch_pawn(self, piece_type):
         """Determine if piece can catch the pawn before it queens"""
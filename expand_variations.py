@@ -11,61 +11,541 @@ transpositions and only drills one move order to reach the same position.
 
 import argparse
 import chess.pgn
+import chess.polyglot
+import hashlib
 import io
+import itertools
+import json
+import os
+import struct
+import sys
+from array import array
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
 from pathlib import Path
-from typing import List, Optional
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
 
-def find_position_in_mainline(game: chess.pgn.Game, board: chess.Board) -> Optional[chess.pgn.ChildNode]:
+WRITE_BUFFER_SIZE = 1 << 20
+# Games queued per worker ahead of the one being written
+REORDER_WINDOW_PER_JOB = 4
+# Polyglot book entry: key, move, weight, learn (big-endian)
+POLYGLOT_ENTRY = struct.Struct(">QHHI")
+POLYGLOT_MAX_WEIGHT = 0xFFFF
+# Bump when the rendered output changes, to invalidate cached games
+CACHE_FORMAT = 2
+# Key of the line ending at a LineTrie node (move codes are >= 0)
+TRIE_LINE = -1
+# Private python-chess helper for SAN without the check suffix; if a release
+# drops it, TreeBuilder falls back to board.san()
+FAST_SAN = hasattr(chess.Board, "_algebraic_without_suffix")
+
+
+class TreeGame:
+    """One game of a MoveTree: its root node, headers and starting position."""
+    
+    __slots__ = ('tree', 'root', 'headers', 'turn', 'fullmove')
+    
+    def __init__(self, tree: 'MoveTree', root: int, headers: chess.pgn.Headers):
+        self.tree = tree
+        self.root = root
+        self.headers = headers
+        self.turn = chess.WHITE
+        self.fullmove = 1
+
+
+class MoveTree:
+    """
+    Compact, array-backed move trees of one or more games.
+    
+    Nodes are indices into parallel arrays. Each game has a root node (parent
+    -1) for its starting position; every other node is a move, stored as a
+    uint16 (from | to << 6 | promotion << 12) with its SAN, NAGs, comment and
+    the position_key() of the position it leads to. Children are linked in
+    variation order, so the first child is the main continuation.
     """
-    Find a node in the main line that matches the given board position.
+    
+    def __init__(self):
+        self.parent = array('i')
+        self.first_child = array('i')
+        self.next_sibling = array('i')
+        self.moves = array('H')
+        self.keys = array('Q')
+        self.comment_ids = array('i')
+        self.sans: List[str] = []
+        self.nags: Dict[int, Tuple[int, ...]] = {}
+        self.comments: List[str] = []
+        self.games: List[TreeGame] = []
+        self._last_child: Dict[int, int] = {}
+    
+    def add_node(self, parent: int, move: Optional[chess.Move] = None, san: str = "") -> int:
+        """Append a node as the last child of `parent` (-1 for a new root)."""
+        node = len(self.parent)
+        self.parent.append(parent)
+        self.first_child.append(-1)
+        self.next_sibling.append(-1)
+        self.moves.append(encode_move(move) if move else 0)
+        self.keys.append(0)
+        self.comment_ids.append(-1)
+        self.sans.append(sys.intern(san))
+        
+        if parent >= 0:
+            last = self._last_child.get(parent, -1)
+            if last < 0:
+                self.first_child[parent] = node
+            else:
+                self.next_sibling[last] = node
+            self._last_child[parent] = node
+        return node
+    
+    def children(self, node: int) -> Iterator[int]:
+        """Child nodes in variation order."""
+        child = self.first_child[node]
+        while child >= 0:
+            yield child
+            child = self.next_sibling[child]
+    
+    def comment(self, node: int) -> str:
+        comment_id = self.comment_ids[node]
+        return self.comments[comment_id] if comment_id >= 0 else ""
+    
+    def add_comment(self, node: int, comment: str):
+        """Append to a node's comment, as chess.pgn.GameBuilder does."""
+        comment = " ".join(filter(None, [self.comment(node), comment]))
+        if not comment:
+            return
+        if self.comment_ids[node] >= 0:
+            self.comments[self.comment_ids[node]] = comment
+        else:
+            self.comment_ids[node] = len(self.comments)
+            self.comments.append(comment)
+    
+    @classmethod
+    def from_game(cls, game: chess.pgn.Game) -> Tuple['MoveTree', List[chess.pgn.GameNode]]:
+        """
+        Build a tree from a parsed game.
+        
+        Returns:
+            The tree, and the GameNode of each tree node
+        """
+        tree = cls()
+        game.accept(TreeBuilder(tree))
+        
+        # Children are added in variation order, so the trees line up
+        nodes = [None] * len(tree.parent)
+        stack = [(tree.games[0].root, game)]
+        while stack:
+            node, game_node = stack.pop()
+            nodes[node] = game_node
+            stack.extend(zip(tree.children(node), game_node.variations))
+        return tree, nodes
+
+
+def encode_move(move: chess.Move) -> int:
+    """Pack a move into 16 bits."""
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+
+def position_key(board: chess.Board) -> int:
+    """
+    64-bit key of a position for transposition lookups.
+    
+    Covers the same state as a Zobrist hash (pieces, side to move, castling
+    rights and a capturable en passant square) but hashes the piece bitboards
+    directly instead of every piece, which makes it much cheaper per move.
+    """
+    ep_square = board.ep_square if board.ep_square is not None and board.has_legal_en_passant() else -1
+    return hash((board.pawns, board.knights, board.bishops, board.rooks, board.queens, board.kings,
+                 board.occupied_co[chess.WHITE], board.occupied_co[chess.BLACK], board.turn,
+                 board.clean_castling_rights(), ep_square)) & 0xFFFFFFFFFFFFFFFF
+
+
+class TreeBuilder(chess.pgn.BaseVisitor):
+    """
+    Visitor for chess.pgn.read_game() that builds a MoveTree instead of
+    GameNode objects.
+    
+    Comments, NAGs and results are attached exactly as chess.pgn.GameBuilder
+    does. Starting comments are dropped, as expanded lines never show them.
+    Pass an existing tree to collect several games in one.
+    """
+    
+    def __init__(self, tree: Optional[MoveTree] = None):
+        self.tree = tree if tree is not None else MoveTree()
+    
+    def begin_game(self):
+        self.game = TreeGame(self.tree, self.tree.add_node(-1), chess.pgn.Headers())
+        self.tree.games.append(self.game)
+        self.variation_stack = [self.game.root]
+        self.in_variation = False
+        self.key_pending = True
+    
+    def begin_headers(self) -> chess.pgn.Headers:
+        return self.game.headers
+    
+    def visit_header(self, tagname: str, tagvalue: str):
+        self.game.headers[tagname] = tagvalue
+    
+    def visit_board(self, board: chess.Board):
+        if self.key_pending:
+            node = self.variation_stack[-1]
+            self.tree.keys[node] = position_key(board)
+            if node == self.game.root:
+                self.game.turn = board.turn
+                self.game.fullmove = board.fullmove_number
+            elif self.tree.moves[node]:
+                # The suffix board.san() adds, judged from the board after the move
+                is_check = board.is_check()
+                if (is_check and board.is_checkmate()) or board.is_variant_loss() or board.is_variant_win():
+                    self.tree.sans[node] = sys.intern(self.tree.sans[node] + "#")
+                elif is_check:
+                    self.tree.sans[node] = sys.intern(self.tree.sans[node] + "+")
+            self.key_pending = False
+    
+    def visit_move(self, board: chess.Board, move: chess.Move):
+        # SAN without its suffix: board.san() would push and pop the move to
+        # look for check, and read_game() pushes it anyway
+        if FAST_SAN:
+            san = board._algebraic_without_suffix(move)
+        else:
+            san = board.san(move).rstrip("+#")
+        self.variation_stack[-1] = self.tree.add_node(self.variation_stack[-1], move, san)
+        self.in_variation = True
+        self.key_pending = True
+    
+    def visit_nag(self, nag: int):
+        node = self.variation_stack[-1]
+        self.tree.nags[node] = tuple(sorted(set(self.tree.nags.get(node, ())) | {nag}))
+    
+    def visit_comment(self, comment: str):
+        node = self.variation_stack[-1]
+        if self.in_variation or (node == self.game.root and self.tree.first_child[node] < 0):
+            self.tree.add_comment(node, comment)
+    
+    def begin_variation(self):
+        self.variation_stack.append(self.tree.parent[self.variation_stack[-1]])
+        self.in_variation = False
+    
+    def end_variation(self):
+        self.variation_stack.pop()
+    
+    def visit_result(self, result: str):
+        if self.game.headers.get("Result", "*") == "*":
+            self.game.headers["Result"] = result
+    
+    def handle_error(self, error: Exception):
+        chess.pgn.LOGGER.error("%s while parsing game %r", error, self.game.headers.get("Event", "?"))
+    
+    def result(self) -> TreeGame:
+        return self.game
+
+
+def read_tree_game(handle, tree: Optional[MoveTree] = None) -> Optional[TreeGame]:
+    """
+    Read the next game of a PGN stream into a MoveTree (a new one by default).
+    
+    Returns:
+        The game, or None at the end of the stream
+    """
+    return chess.pgn.read_game(handle, Visitor=lambda: TreeBuilder(tree))
+
+
+def index_mainline(tree: MoveTree, root: int) -> Tuple[List[int], Dict[int, int]]:
+    """
+    Precompute the main line of a game once.
+    
+    Positions are keyed by position_key(), so a transposition is found
+    whatever move order (and move counters) led to it.
     
     Args:
-        game: The game to search
-        board: The position to find
+        tree: Tree holding the game
+        root: Root node of the game
         
     Returns:
-        Node in main line with matching position, or None
+        The main line nodes in order, and a map from the position key of each
+        main line position to the index of the first node reaching it
     """
-    current = game
+    nodes = []
+    positions = {}
+    current = tree.first_child[root]
     
     # Traverse the main line only (first variation at each node)
-    while current.variations:
-        current = current.variations[0]
-        if current.board() == board:
-            return current
+    while current >= 0:
+        positions.setdefault(tree.keys[current], len(nodes))
+        nodes.append(current)
+        current = tree.first_child[current]
+    
+    return nodes, positions
+
+
+class TranspositionGraph:
+    """
+    Position graph across every game of a repertoire.
     
-    return None
+    Each position, keyed by position_key(), maps to the moves played from it in
+    any game or variation, so a line can be continued from wherever else its
+    final position occurs.
+    """
+    
+    def __init__(self, tree: MoveTree):
+        self.tree = tree
+        # key -> {move: first node playing it}
+        self.edges: Dict[int, Dict[int, int]] = {}
+        self._cyclic: Optional[Set[int]] = None
+        for game in tree.games:
+            self.add_game(game)
+    
+    def add_game(self, game: TreeGame):
+        """Add every move of a game, variations included."""
+        tree = self.tree
+        stack = list(reversed(list(tree.children(game.root))))
+        
+        # Depth first, main line before sidelines
+        while stack:
+            node = stack.pop()
+            moves = self.edges.setdefault(tree.keys[tree.parent[node]], {})
+            moves.setdefault(tree.moves[node], node)
+            stack.extend(reversed(list(tree.children(node))))
+        self._cyclic = None
+    
+    def successors(self, key: int) -> List[int]:
+        """Nodes for the moves played from a position."""
+        return list(self.edges.get(key, {}).values())
+    
+    def cyclic_keys(self) -> Set[int]:
+        """Positions on a cycle of the graph, that a line could run back into."""
+        if self._cyclic is not None:
+            return self._cyclic
+        
+        keys = self.tree.keys
+        onward = {key: [keys[node] for node in moves.values()] for key, moves in self.edges.items()}
+        # Tarjan's strongly connected components, iteratively
+        index: Dict[int, int] = {}
+        low: Dict[int, int] = {}
+        component: List[int] = []
+        on_component = set()
+        cyclic = set()
+        for root in onward:
+            if root in index:
+                continue
+            index[root] = low[root] = len(index)
+            component.append(root)
+            on_component.add(root)
+            work = [(root, iter(onward[root]))]
+            while work:
+                key, children = work[-1]
+                child = next(children, None)
+                if child is not None:
+                    if child not in index:
+                        index[child] = low[child] = len(index)
+                        component.append(child)
+                        on_component.add(child)
+                        work.append((child, iter(onward.get(child, ()))))
+                    elif child in on_component:
+                        low[key] = min(low[key], index[child])
+                    continue
+                
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low[parent] = min(low[parent], low[key])
+                if low[key] == index[key]:
+                    members = []
+                    while not members or members[-1] != key:
+                        members.append(component.pop())
+                        on_component.discard(members[-1])
+                    if len(members) > 1 or key in onward.get(key, ()):
+                        cyclic.update(members)
+        
+        self._cyclic = cyclic
+        return cyclic
+    
+    def count_lines(self, key: int, depth: int = 0, max_depth: Optional[int] = None,
+                    memo: Optional[Dict] = None, path_keys: Iterable[int] = ()) -> int:
+        """
+        Count the lines iter_paths() continues from a position, without building them.
+        
+        A dynamic program over the graph: a position with no onward moves
+        ends one line, any other position sums over its moves. Moves back
+        into a position on the line are skipped, as in iter_paths(). A count
+        is only memoised when no position on a cycle was reached, since only
+        then it does not depend on the positions the line came through; on
+        cycles this enumerates the paths like iter_paths() does.
+        
+        Args:
+            key: position_key() of the position
+            depth: Plies played to reach the position
+            max_depth: Line length limit, as for iter_paths()
+            memo: Counts shared between calls with the same max_depth
+            path_keys: position_key() of each earlier position of the line
+            
+        Returns:
+            Number of lines
+        """
+        if memo is None:
+            memo = {}
+        keys = self.tree.keys
+        cyclic = self.cyclic_keys()
+        
+        def state(key, depth):
+            return key if max_depth is None else (key, depth)
+        
+        def onward(key, depth):
+            if max_depth is not None and depth >= max_depth:
+                return iter(())
+            return iter([(keys[child], depth + 1) for child in self.edges.get(key, {}).values()])
+        
+        start = state(key, depth)
+        if start in memo:
+            return memo[start]
+        
+        # Frames of [key, depth, onward moves, lines so far, any onward move counted,
+        # count depends on the path (a position on a cycle was reached)]
+        stack = [[key, depth, onward(key, depth), 0, False, key in cyclic]]
+        in_progress = {}
+        for path_key in path_keys:
+            in_progress[path_key] = in_progress.get(path_key, 0) + 1
+        in_progress[key] = in_progress.get(key, 0) + 1
+        while True:
+            frame = stack[-1]
+            step = next(frame[2], None)
+            if step is None:
+                stack.pop()
+                in_progress[frame[0]] -= 1
+                if not in_progress[frame[0]]:
+                    del in_progress[frame[0]]
+                lines = frame[3] if frame[4] else 1
+                if not frame[5]:
+                    memo[state(frame[0], frame[1])] = lines
+                if not stack:
+                    return lines
+                stack[-1][3] += lines
+                stack[-1][4] = True
+                stack[-1][5] = stack[-1][5] or frame[5]
+                continue
+            
+            child_key, child_depth = step
+            if child_key in in_progress:
+                frame[5] = True
+                continue
+            child_state = state(child_key, child_depth)
+            if child_state in memo:
+                frame[3] += memo[child_state]
+                frame[4] = True
+                continue
+            in_progress[child_key] = in_progress.get(child_key, 0) + 1
+            stack.append([child_key, child_depth, onward(child_key, child_depth), 0, False, child_key in cyclic])
 
 
-def get_continuation_from_node(node: chess.pgn.ChildNode) -> List[chess.pgn.ChildNode]:
+def iter_paths(tree: MoveTree, node: int, prefix: List[int] = (),
+               mainline: Optional[Tuple[List[int], Dict[int, int]]] = None,
+               graph: Optional[TranspositionGraph] = None,
+               max_depth: Optional[int] = None) -> Iterator[List[int]]:
     """
-    Get all moves following a node in the main line.
+    Lazily walk every unique path through the game tree.
+    
+    The tree is walked depth-first over a single shared move stack, so memory
+    is proportional to the depth of the tree rather than to the number of
+    paths. When a variation ends, the main line continuation (if any) is
+    appended for the duration of the yield.
+    
+    With a transposition graph, a variation that ends instead continues with
+    every move played from its final position anywhere in the repertoire,
+    never returning to a position already on the path.
+    
+    The yielded list IS the move stack: it is only valid until the next path
+    is requested. Copy it (list(path)) to keep it.
     
     Args:
-        node: Node to start from
+        tree: Tree holding the game (and, with a graph, every other game)
+        node: Node to start from, usually the root of a game
+        prefix: Nodes leading from the root to `node`
+        mainline: Result of index_mainline() for the game (computed if omitted)
+        graph: Repertoire-wide transposition graph to continue lines from
+        max_depth: Cut lines after this many plies (sidelines branching
+                   later are not followed)
         
-    Returns:
-        List of moves following this node in the main line
+    Yields:
+        Paths, each a list of nodes from root to leaf
     """
-    continuation = []
-    current = node
+    if graph is None and mainline is None:
+        root = node
+        while tree.parent[root] >= 0:
+            root = tree.parent[root]
+        mainline = index_mainline(tree, root)
     
-    # Follow the main line (first variation)
-    while current.variations:
-        main_move = current.variations[0]
-        continuation.append(main_move)
-        current = main_move
+    tree_keys = tree.keys
+    first_child = tree.first_child
+    path = list(prefix)
+    base = len(path)
+    keys = [tree_keys[node]]
+    on_path = {keys[0]: 1}
+    left_tree_at = None  # path length at which the walk left the tree for the graph
+    stack = []
+    current = node
     
-    return continuation
+    while True:
+        if max_depth is not None and len(path) >= max_depth:
+            # Depth limit reached - the line ends here
+            if path:
+                yield path
+            stack.append(iter(()))
+        elif left_tree_at is None and first_child[current] >= 0:
+            stack.append(tree.children(current))
+        elif graph is None:
+            # Leaf node - check if we can continue from main line
+            if path:
+                mainline_nodes, positions = mainline
+                depth = len(path)
+                index = positions.get(keys[-1])
+                if index is not None:
+                    end = None if max_depth is None else index + 1 + max_depth - depth
+                    path.extend(mainline_nodes[index + 1:end])
+                yield path
+                del path[depth:]
+            stack.append(iter(()))
+        else:
+            # Leaf node - carry on through the graph, avoiding cycles
+            successors = []
+            if path:
+                successors = [child for child in graph.successors(keys[-1]) if tree_keys[child] not in on_path]
+                if not successors:
+                    yield path
+                elif left_tree_at is None:
+                    left_tree_at = len(path)
+            stack.append(iter(successors))
+        
+        # Step to the next unvisited move, backing up past exhausted ones
+        while stack:
+            child = next(stack[-1], None)
+            if child is not None:
+                break
+            stack.pop()
+            if stack:
+                path.pop()
+                key = keys.pop()
+                on_path[key] -= 1
+                if not on_path[key]:
+                    del on_path[key]
+                if left_tree_at is not None and len(path) < left_tree_at:
+                    left_tree_at = None
+        if not stack:
+            return
+        
+        path.append(child)
+        key = tree_keys[child]
+        keys.append(key)
+        on_path[key] = on_path.get(key, 0) + 1
+        current = child
 
 
-def extract_all_paths(game: chess.pgn.Game, node: chess.pgn.GameNode, current_path: List[chess.pgn.ChildNode]) -> List[List[chess.pgn.ChildNode]]:
+def extract_all_paths(game: chess.pgn.Game, node: chess.pgn.GameNode, current_path: List[chess.pgn.ChildNode]
+                      ) -> List[List[chess.pgn.ChildNode]]:
     """
-    Recursively extract all unique paths through the game tree.
+    Extract all unique paths through the game tree.
     
-    When a variation ends, find if the resulting position exists in the main line,
-    and if so, continue from that point.
+    Kept for callers working with chess.pgn objects: the game is converted
+    to a MoveTree and the paths of iter_paths() mapped back to its nodes.
     
     Args:
         game: The original game (needed to search main line)
@@ -75,34 +555,52 @@ def extract_all_paths(game: chess.pgn.Game, node: chess.pgn.GameNode, current_pa
     Returns:
         List of paths, where each path is a list of nodes from root to leaf
     """
-    paths = []
+    tree, nodes = MoveTree.from_game(game)
+    index = {id(game_node): tree_node for tree_node, game_node in enumerate(nodes)}
+    prefix = [index[id(game_node)] for game_node in current_path]
+    return [[nodes[tree_node] for tree_node in path]
+            for path in iter_paths(tree, index[id(node)], prefix)]
+
+
+def count_lines(game: TreeGame, graph: Optional[TranspositionGraph] = None,
+                max_depth: Optional[int] = None, memo: Optional[Dict] = None) -> int:
+    """
+    Count the lines iter_paths() would produce for a game, without building them.
     
-    if not node.variations:
-        # Leaf node - check if we can continue from main line
-        if current_path:
-            # Get the board position at the end of current path
-            end_board = current_path[-1].board()
-            
-            # Try to find this position in the main line
-            mainline_node = find_position_in_mainline(game, end_board)
-            
-            if mainline_node:
-                # Continue with moves after this position in main line
-                continuation = get_continuation_from_node(mainline_node)
-                complete_path = current_path + continuation
-                paths.append(complete_path)
-            else:
-                # No continuation found, path ends here
-                paths.append(current_path)
-        return paths
+    With a transposition graph the continuations are counted by
+    TranspositionGraph.count_lines().
+    
+    Args:
+        game: The game to count
+        graph: Repertoire-wide transposition graph, as for iter_paths()
+        max_depth: Line length limit, as for iter_paths()
+        memo: Graph counts shared between games
+        
+    Returns:
+        Number of lines
+    """
+    tree = game.tree
+    lines = 0
+    stack = [(child, 1) for child in tree.children(game.root)]
     
-    # Process all variations at this node
-    for variation in node.variations:
-        new_path = current_path + [variation]
-        sub_paths = extract_all_paths(game, variation, new_path)
-        paths.extend(sub_paths)
+    while stack:
+        node, depth = stack.pop()
+        if max_depth is not None and depth >= max_depth:
+            lines += 1
+        elif tree.first_child[node] >= 0:
+            stack.extend((child, depth + 1) for child in tree.children(node))
+        elif graph is None:
+            # A main line continuation extends the line but doesn't add any
+            lines += 1
+        else:
+            path_keys = []
+            ancestor = tree.parent[node]
+            while ancestor >= 0:
+                path_keys.append(tree.keys[ancestor])
+                ancestor = tree.parent[ancestor]
+            lines += graph.count_lines(tree.keys[node], depth, max_depth, memo, path_keys)
     
-    return paths
+    return lines
 
 
 def create_game_from_path(original_game: chess.pgn.Game, path: List[chess.pgn.ChildNode]) -> chess.pgn.Game:
@@ -137,54 +635,644 @@ def create_game_from_path(original_game: chess.pgn.Game, path: List[chess.pgn.Ch
     return new_game
 
 
-def expand_variations(input_file: str, output_file: str) -> int:
+class OutputFiles:
+    """
+    Text output that moves on to a new numbered file once a size limit is reached.
+    
+    Each write is kept whole, so a game is never split between files. Text is
+    encoded to UTF-8 here so the limit counts bytes, not characters.
+    """
+    
+    def __init__(self, path: str, max_size: Optional[int] = None):
+        self.path = Path(path)
+        self.max_size = max_size
+        self.paths = []
+        self.size = 0
+        self.handle = None
+        self._open_next()
+    
+    def _open_next(self):
+        if self.handle is not None:
+            self.handle.close()
+        if self.max_size is None:
+            path = self.path
+        else:
+            path = self.path.with_name(f"{self.path.stem}_{len(self.paths) + 1:03d}{self.path.suffix}")
+        self.handle = open(path, 'wb', buffering=WRITE_BUFFER_SIZE)
+        self.paths.append(path)
+        self.size = 0
+    
+    def write(self, text: str):
+        data = text.encode('utf-8')
+        if self.max_size is not None and self.size and self.size + len(data) > self.max_size:
+            self._open_next()
+        self.handle.write(data)
+        self.size += len(data)
+    
+    def close(self):
+        self.handle.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class LineWriter:
+    """
+    Write expanded lines as PGN text without building a Game per line.
+    
+    SAN, NAGs and comments are rendered once per tree node and headers once
+    per game, so writing a line is a string join. The output is identical to
+    print(create_game_from_path(game, path), end="\\n\\n").
+    """
+    
+    def __init__(self, out_file, tree: MoveTree):
+        self.out_file = out_file
+        self.tree = tree
+        # node -> rendered move with NAGs and comment (filled in on first use)
+        self.tokens: Dict[int, str] = {}
+        # root -> header block
+        self.header_blocks: Dict[int, str] = {}
+    
+    def header_block(self, game: TreeGame) -> str:
+        block = self.header_blocks.get(game.root)
+        if block is None:
+            block = "".join(f'[{key} "{value}"]\n' for key, value in game.headers.items()) + "\n"
+            self.header_blocks[game.root] = block
+        return block
+    
+    def token(self, node: int) -> str:
+        token = self.tokens.get(node)
+        if token is None:
+            tree = self.tree
+            token = tree.sans[node] + " "
+            for nag in tree.nags.get(node, ()):
+                token += f"${nag} "
+            if tree.comment_ids[node] >= 0:
+                token += "{ " + tree.comment(node).replace("}", "").strip() + " } "
+            self.tokens[node] = token
+        return token
+    
+    def write(self, game: TreeGame, path: List[int]):
+        """Write one line of a game with the game's headers."""
+        self.out_file.write(self.render(game, path))
+    
+    def render(self, game: TreeGame, path: List[int]) -> str:
+        """PGN text of one line of a game with the game's headers."""
+        comment_ids = self.tree.comment_ids
+        white = game.turn
+        fullmove = game.fullmove
+        parts = [self.header_block(game)]
+        force_number = True
+        
+        for node in path:
+            if white:
+                parts.append(f"{fullmove}. ")
+            elif force_number:
+                parts.append(f"{fullmove}... ")
+            parts.append(self.token(node))
+            # A comment interrupts the move pair, so the next move is numbered
+            force_number = comment_ids[node] >= 0
+            if not white:
+                fullmove += 1
+            white = not white
+        
+        parts.append(game.headers.get("Result", "*"))
+        return "".join(parts) + "\n\n"
+    
+    def render_game(self, game: TreeGame) -> str:
+        """PGN text of a game without moves, as str(game) would give it."""
+        parts = [self.header_block(game)]
+        if self.tree.comment_ids[game.root] >= 0:
+            parts.append("{ " + self.tree.comment(game.root).replace("}", "").strip() + " } ")
+        parts.append(game.headers.get("Result", "*"))
+        return "".join(parts) + "\n\n"
+
+
+class LineTrie:
+    """
+    Move-sequence trie over expanded lines that drops redundant ones.
+    
+    A line identical to an earlier one is a duplicate; a line that is a
+    strict prefix of another (earlier or later) line is subsumed by it.
+    Either way it is dropped, so output has to wait until every line of the
+    scope (a game, or the whole repertoire) has been added.
+    """
+    
+    def __init__(self):
+        self.root = {}
+        # Text of each line in the order added, None once dropped
+        self.lines: List[Optional[str]] = []
+        self.duplicates = 0
+        self.subsumed = 0
+    
+    def add(self, moves: Iterable[int], text: str):
+        """Add a line, given as move codes from its starting position."""
+        node = self.root
+        for move in moves:
+            earlier = node.pop(TRIE_LINE, None)
+            if earlier is not None:
+                # An earlier line stops here: it's a prefix of this one
+                self.lines[earlier] = None
+                self.subsumed += 1
+            node = node.setdefault(move, {})
+        
+        if TRIE_LINE in node:
+            self.duplicates += 1
+        elif node:
+            # A longer line already continues from here
+            self.subsumed += 1
+        else:
+            node[TRIE_LINE] = len(self.lines)
+            self.lines.append(text)
+    
+    def keep(self, text: str):
+        """Add output that takes no part in the comparison (a game without moves)."""
+        self.lines.append(text)
+    
+    def kept(self) -> List[str]:
+        """Text of the remaining lines, in the order they were added."""
+        return [text for text in self.lines if text is not None]
+
+
+class PruneStats:
+    """Lines dropped by LineTrie, summed over games."""
+    
+    def __init__(self):
+        self.duplicates = 0
+        self.subsumed = 0
+    
+    def add(self, duplicates: int, subsumed: int):
+        self.duplicates += duplicates
+        self.subsumed += subsumed
+
+
+class _LineRecorder:
+    """Readable handle that keeps every line read through it."""
+    
+    def __init__(self, handle):
+        self.handle = handle
+        self.lines = []
+    
+    def readline(self) -> str:
+        line = self.handle.readline()
+        self.lines.append(line)
+        return line
+
+
+def iter_game_texts(pgn_file) -> Iterator[str]:
+    """
+    Split a PGN stream into the raw text of each game, without parsing moves.
+    
+    Boundaries come from chess.pgn.skip_game(), so each text parses to
+    exactly the game chess.pgn.read_game() would have read.
+    """
+    recorder = _LineRecorder(pgn_file)
+    while True:
+        recorder.lines = []
+        if not chess.pgn.skip_game(recorder):
+            return
+        yield "".join(recorder.lines)
+
+
+def _expand_game_text(text: str, max_depth: Optional[int], max_lines: Optional[int],
+                      prune: bool = False) -> Tuple[List[str], int, int]:
+    """
+    Worker: expand the raw text of one game into the PGN text of each line.
+    
+    Returns:
+        The text of each line, and the number of duplicate and subsumed
+        lines dropped
+    """
+    game = read_tree_game(io.StringIO(text))
+    tree = game.tree
+    writer = LineWriter(None, tree)
+    paths = iter_paths(tree, game.root, max_depth=max_depth)
+    
+    if not prune:
+        lines = [writer.render(game, path) for path in itertools.islice(paths, max_lines)]
+        return lines or [writer.render_game(game)], 0, 0
+    
+    trie = LineTrie()
+    for path in paths:
+        trie.add([tree.moves[node] for node in path], writer.render(game, path))
+    return trie.kept() or [writer.render_game(game)], trie.duplicates, trie.subsumed
+
+
+def line_digest(game: TreeGame, path: List[int]) -> bytes:
+    """Digest identifying the sequence of moves of a path from its starting position."""
+    tree = game.tree
+    digest = hashlib.blake2b(tree.keys[game.root].to_bytes(8, 'little'), digest_size=16)
+    digest.update(array('H', [tree.moves[node] for node in path]).tobytes())
+    return digest.digest()
+
+
+class ExpansionCache:
+    """
+    On-disk cache of expanded games.
+    
+    Entries are keyed by a hash of the game's raw text, the expansion options
+    and the output format, so an unchanged game is never expanded twice and
+    an edited one simply misses. Entries are never pruned; delete the
+    directory to reclaim space.
+    """
+    
+    def __init__(self, directory: str, max_lines: Optional[int] = None, max_depth: Optional[int] = None,
+                 prune: bool = False):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.options = f"{CACHE_FORMAT}:{chess.__version__}:{max_lines}:{max_depth}:{prune}".encode()
+        self.hits = 0
+        self.misses = 0
+    
+    def _path(self, text: str) -> Path:
+        digest = hashlib.blake2b(self.options, digest_size=20)
+        digest.update(b"\0" + text.encode('utf-8'))
+        return self.directory / f"{digest.hexdigest()}.json"
+    
+    def get(self, text: str) -> Optional[Tuple[List[str], int, int]]:
+        """Cached result of _expand_game_text() for a game, or None."""
+        try:
+            with open(self._path(text), 'r', encoding='utf-8') as cache_file:
+                lines, duplicates, subsumed = json.load(cache_file)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return lines, duplicates, subsumed
+    
+    def put(self, text: str, lines: Tuple[List[str], int, int]):
+        """Store the result of _expand_game_text() for a game."""
+        path = self._path(text)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as cache_file:
+            json.dump(lines, cache_file)
+        os.replace(tmp_path, path)
+
+
+def expand_game_texts(pgn_file, out_file, jobs: int = 1, max_lines: Optional[int] = None,
+                      max_depth: Optional[int] = None, cache: Optional[ExpansionCache] = None,
+                      prune: Optional[PruneStats] = None) -> int:
+    """
+    Expand games one raw game text at a time, writing them back in input order.
+    
+    With more than one job, games are expanded in a process pool. Results
+    are kept in submission order, at most REORDER_WINDOW_PER_JOB per worker
+    ahead of the one being written, so finished games wait for their
+    predecessors and memory stays bounded. Games found in the cache are
+    spliced in without being parsed at all.
+    
+    Args:
+        pgn_file: Input PGN stream
+        out_file: Output stream
+        jobs: Number of worker processes (1 expands in this process)
+        max_lines: Stop after writing this many games
+        max_depth: Cut lines after this many plies
+        cache: Cache of previously expanded games
+        prune: Drop duplicate and subsumed lines within each game, counting
+               them here
+        
+    Returns:
+        Number of games written
+    """
+    games_written = 0
+    texts = iter_game_texts(pgn_file)
+    options = (max_depth, max_lines, prune is not None)
+    pool = ProcessPoolExecutor(jobs) if jobs > 1 else None
+    
+    def submit(text):
+        lines = cache.get(text) if cache is not None else None
+        if lines is not None:
+            return text, lines, True
+        if pool is None:
+            return text, _expand_game_text(text, *options), False
+        return text, pool.submit(_expand_game_text, text, *options), False
+    
+    try:
+        pending = deque(submit(text) for text in itertools.islice(texts, max(jobs, 1) * REORDER_WINDOW_PER_JOB))
+        
+        while pending:
+            text, lines, cached = pending.popleft()
+            if isinstance(lines, Future):
+                lines = lines.result()
+            if cache is not None and not cached:
+                cache.put(text, lines)
+            lines, duplicates, subsumed = lines
+            if prune is not None:
+                prune.add(duplicates, subsumed)
+            text = next(texts, None)
+            if text is not None:
+                pending.append(submit(text))
+            
+            for line in lines:
+                if max_lines is not None and games_written >= max_lines:
+                    for _, future, _ in pending:
+                        if isinstance(future, Future):
+                            future.cancel()
+                    return games_written
+                out_file.write(line)
+                games_written += 1
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    
+    return games_written
+
+
+def write_kept(trie: LineTrie, out_file, max_lines: Optional[int], games_written: int) -> int:
+    """Write the lines a trie kept, up to max_lines in all. Returns the number written."""
+    lines = trie.kept()
+    if max_lines is not None:
+        lines = lines[:max(max_lines - games_written, 0)]
+    for line in lines:
+        out_file.write(line)
+    return len(lines)
+
+
+def expand_variations(input_file: str, output_file: str, repertoire: bool = False,
+                      max_lines: Optional[int] = None, max_depth: Optional[int] = None,
+                      split_size: Optional[int] = None, jobs: int = 1,
+                      cache: Optional[ExpansionCache] = None,
+                      prune: Optional[PruneStats] = None) -> int:
     """
     Read PGN file and expand all variations into separate games.
     
     Args:
         input_file: Path to input PGN file
         output_file: Path to output PGN file
+        repertoire: Continue lines through transpositions anywhere in the
+                    file rather than only the same game's main line. Each
+                    distinct line is written once.
+        max_lines: Stop after writing this many games
+        max_depth: Cut lines after this many plies
+        split_size: Start a new numbered output file (name_001.pgn, ...)
+                    whenever the current one would exceed this many bytes
+        jobs: Expand this many games at a time in worker processes. The
+              output is the same as with one job. Not supported together
+              with `repertoire`.
+        cache: Reuse (and store) the output of unchanged games, created
+               with the same max_lines, max_depth and pruning. Not
+               supported together with `repertoire`.
+        prune: Drop lines identical to, or a strict prefix of, another line
+               of the same game (of the whole file with `repertoire`),
+               counting them here. Output is held back until that scope is
+               complete.
         
     Returns:
         Number of games written
     """
+    if (jobs > 1 or cache is not None) and repertoire:
+        raise ValueError("parallel or cached expansion can't be combined with repertoire mode")
+    
     games_written = 0
     
     with open(input_file, 'r', encoding='utf-8') as pgn_file:
-        with open(output_file, 'w', encoding='utf-8') as out_file:
+        with OutputFiles(output_file, split_size) as out_file:
+            if jobs > 1 or cache is not None:
+                return expand_game_texts(pgn_file, out_file, jobs, max_lines, max_depth, cache, prune)
+            
+            if repertoire:
+                # The whole file is needed up front to find every transposition
+                tree = MoveTree()
+                while read_tree_game(pgn_file, tree) is not None:
+                    pass
+                games = tree.games
+                graph = TranspositionGraph(tree)
+                writer = LineWriter(out_file, tree)
+                seen = set()
+            else:
+                games = iter(lambda: read_tree_game(pgn_file), None)
+                graph = None
+            trie = None
             
-            while True:
-                # Read next game from input
-                game = chess.pgn.read_game(pgn_file)
-                if game is None:
+            for game in games:
+                if max_lines is not None and games_written >= max_lines:
                     break
+                if graph is None:
+                    writer = LineWriter(out_file, game.tree)
+                if prune is not None and (graph is None or trie is None):
+                    trie = LineTrie()
                 
-                # Extract all paths through the variation tree
-                paths = extract_all_paths(game, game, [])
+                # Write each path as soon as the walk reaches its leaf
+                expanded = False
+                for path in iter_paths(game.tree, game.root, graph=graph, max_depth=max_depth):
+                    expanded = True
+                    if trie is not None:
+                        # Start with the position so only lines from the same one compare
+                        moves = [game.tree.keys[game.root]] + [game.tree.moves[node] for node in path]
+                        trie.add(moves, writer.render(game, path))
+                        continue
+                    if graph is not None:
+                        digest = line_digest(game, path)
+                        if digest in seen:
+                            continue
+                        seen.add(digest)
+                    if max_lines is not None and games_written >= max_lines:
+                        break
+                    writer.write(game, path)
+                    games_written += 1
                 
-                if not paths:
+                if not expanded:
                     # No moves in game, write it as-is
-                    print(game, file=out_file, end="\n\n")
-                    games_written += 1
-                else:
-                    # Create a separate game for each path
-                    for path in paths:
-                        new_game = create_game_from_path(game, path)
-                        print(new_game, file=out_file, end="\n\n")
+                    if trie is not None:
+                        trie.keep(writer.render_game(game))
+                    else:
+                        out_file.write(writer.render_game(game))
                         games_written += 1
+                
+                if trie is not None and graph is None:
+                    games_written += write_kept(trie, out_file, max_lines, games_written)
+                    prune.add(trie.duplicates, trie.subsumed)
+            
+            if trie is not None and graph is not None:
+                games_written += write_kept(trie, out_file, max_lines, games_written)
+                prune.add(trie.duplicates, trie.subsumed)
     
     return games_written
 
 
+def polyglot_move(board: chess.Board, move: chess.Move) -> int:
+    """Encode a move as in a Polyglot book entry."""
+    to_square = move.to_square
+    if board.is_castling(move) and not board.chess960:
+        # Polyglot writes castling as the king capturing its own rook
+        rook_file = 7 if board.is_kingside_castling(move) else 0
+        to_square = chess.square(rook_file, chess.square_rank(move.from_square))
+    # Knight, bishop, rook, queen are 1-4 in Polyglot, 2-5 in python-chess
+    promotion = move.promotion - 1 if move.promotion else 0
+    return (chess.square_file(to_square)
+            | chess.square_rank(to_square) << 3
+            | chess.square_file(move.from_square) << 6
+            | chess.square_rank(move.from_square) << 9
+            | promotion << 12)
+
+
+class RepertoireBook:
+    """
+    The moves played from each position of a repertoire.
+    
+    Positions are merged across games and variations by Zobrist hash, so a
+    position reached by transposition offers every move played from it
+    anywhere. A move's weight is the number of times it occurs.
+    """
+    
+    def __init__(self):
+        # key -> (EPD, {Polyglot move: [SAN, weight]})
+        self.positions: Dict[int, Tuple[str, Dict[int, List]]] = {}
+    
+    def add_game(self, game: chess.pgn.Game):
+        """Add every move of a game, variations included."""
+        board = game.board()
+        stack = [iter(game.variations)]
+        
+        while stack:
+            child = next(stack[-1], None)
+            if child is None:
+                stack.pop()
+                if stack:
+                    board.pop()
+                continue
+            
+            key = chess.polyglot.zobrist_hash(board)
+            if key not in self.positions:
+                self.positions[key] = (board.epd(), {})
+            moves = self.positions[key][1]
+            encoded = polyglot_move(board, child.move)
+            if encoded in moves:
+                moves[encoded][1] += 1
+            else:
+                moves[encoded] = [board.san(child.move), 1]
+            
+            board.push(child.move)
+            stack.append(iter(child.variations))
+    
+    def write_polyglot(self, path: str) -> int:
+        """
+        Write the book in Polyglot .bin format.
+        
+        Returns:
+            Number of entries written
+        """
+        entries = sorted(
+            (key, -min(weight, POLYGLOT_MAX_WEIGHT), move)
+            for key, (_, moves) in self.positions.items()
+            for move, (_, weight) in moves.items()
+        )
+        with open(path, 'wb', buffering=WRITE_BUFFER_SIZE) as book_file:
+            for key, weight, move in entries:
+                book_file.write(POLYGLOT_ENTRY.pack(key, move, -weight, 0))
+        return len(entries)
+    
+    def write_position_map(self, path: str) -> int:
+        """
+        Write the book as JSON, mapping each position's EPD to {SAN: weight},
+        most played move first.
+        
+        Returns:
+            Number of positions written
+        """
+        position_map = {
+            epd: dict(sorted(moves.values(), key=lambda move: -move[1]))
+            for epd, moves in self.positions.values()
+        }
+        with open(path, 'w', encoding='utf-8') as map_file:
+            json.dump(position_map, map_file, separators=(',', ':'))
+        return len(position_map)
+
+
+def export_book(input_file: str, book_file: Optional[str] = None,
+                position_map_file: Optional[str] = None) -> Tuple[int, int]:
+    """
+    Export the variation tree of every game in a PGN file as an opening book.
+    
+    Args:
+        input_file: Path to input PGN file
+        book_file: Path for the Polyglot .bin book
+        position_map_file: Path for the JSON position map
+        
+    Returns:
+        Number of positions and number of moves in the book
+    """
+    book = RepertoireBook()
+    with open(input_file, 'r', encoding='utf-8') as pgn_file:
+        for game in iter(lambda: chess.pgn.read_game(pgn_file), None):
+            book.add_game(game)
+    
+    if book_file:
+        book.write_polyglot(book_file)
+    if position_map_file:
+        book.write_position_map(position_map_file)
+    return len(book.positions), sum(len(moves) for _, moves in book.positions.values())
+
+
+def count_expanded_lines(input_file: str, repertoire: bool = False,
+                         max_depth: Optional[int] = None) -> List[Tuple[str, int]]:
+    """
+    Count the games expand_variations() would write, without writing them.
+    
+    Args:
+        input_file: Path to input PGN file
+        repertoire: As for expand_variations()
+        max_depth: As for expand_variations()
+        
+    Returns:
+        (Event header, number of games) for each game in the file
+    """
+    with open(input_file, 'r', encoding='utf-8') as pgn_file:
+        if repertoire:
+            tree = MoveTree()
+            while read_tree_game(pgn_file, tree) is not None:
+                pass
+            games = tree.games
+            graph = TranspositionGraph(tree)
+        else:
+            games = iter(lambda: read_tree_game(pgn_file), None)
+            graph = None
+        
+        memo = {}
+        return [(game.headers.get("Event", "?"), count_lines(game, graph, max_depth, memo) or 1)
+                for game in games]
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='Expand PGN variations into separate complete games.',
         epilog='Example: python expand_variations.py input.pgn -o output.pgn'
     )
     parser.add_argument('input', help='Input PGN file with variations')
-    parser.add_argument('-o', '--output', required=True, help='Output PGN file')
+    parser.add_argument('-o', '--output', help='Output PGN file')
+    parser.add_argument('--repertoire', action='store_true',
+                        help='Continue lines through transpositions into any game in the file, '
+                             'not just the main line of the same game; write each distinct line once')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only count the games that would be written, per input game')
+    parser.add_argument('--max-lines', type=int, metavar='N',
+                        help='Stop after writing N games')
+    parser.add_argument('--max-depth', type=int, metavar='PLIES',
+                        help='Cut lines after PLIES half-moves')
+    parser.add_argument('--split-size', type=float, metavar='MB',
+                        help='Split output into numbered files (output_001.pgn, ...) of at most MB megabytes')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Expand games in this many worker processes (default: 1)')
+    parser.add_argument('--prune', action='store_true',
+                        help='Drop lines identical to, or a strict prefix of, another line of the same game '
+                             '(of the whole file with --repertoire)')
+    parser.add_argument('--cache', metavar='DIR',
+                        help='Cache each expanded game in DIR and reuse it while the game is unchanged')
+    parser.add_argument('--book', metavar='BIN',
+                        help='Export every position and move of the input as a Polyglot opening book')
+    parser.add_argument('--position-map', metavar='JSON',
+                        help='Export every position (EPD) of the input with its moves and weights as JSON')
     
     args = parser.parse_args()
+    if not (args.output or args.dry_run or args.book or args.position_map):
+        parser.error("one of -o/--output, --dry-run, --book or --position-map is required")
+    if args.jobs > 1 and args.repertoire:
+        parser.error("--jobs can't be combined with --repertoire")
+    if args.cache and args.repertoire:
+        parser.error("--cache can't be combined with --repertoire")
     
     # Validate input file exists
     if not Path(args.input).exists():
@@ -192,11 +1280,48 @@ def main():
         return 1
     
     try:
-        games_written = expand_variations(args.input, args.output)
+        if args.book or args.position_map:
+            positions, moves = export_book(args.input, args.book, args.position_map)
+            print(f"Exported book from {args.input}: {positions} positions, {moves} moves")
+            if args.book:
+                print(f"Polyglot book: {args.book}")
+            if args.position_map:
+                print(f"Position map: {args.position_map}")
+            if not (args.output or args.dry_run):
+                return 0
+        
+        if args.dry_run:
+            counts = count_expanded_lines(args.input, args.repertoire, args.max_depth)
+            total = sum(lines for _, lines in counts)
+            print(f"Input: {args.input}")
+            print(f"Input games: {len(counts)}")
+            print(f"Games that would be written: {total}")
+            if counts:
+                event, lines = max(counts, key=lambda count: count[1])
+                print(f"Largest: {event} ({lines} games)")
+            if args.max_lines is not None and total > args.max_lines:
+                print(f"--max-lines would stop output after {args.max_lines} games")
+            return 0
+        
+        split_size = None if args.split_size is None else int(args.split_size * 1024 * 1024)
+        cache = ExpansionCache(args.cache, args.max_lines, args.max_depth, args.prune) if args.cache else None
+        prune = PruneStats() if args.prune else None
+        games_written = expand_variations(args.input, args.output, args.repertoire,
+                                          args.max_lines, args.max_depth, split_size, args.jobs, cache, prune)
         print(f"Successfully expanded variations.")
         print(f"Input: {args.input}")
-        print(f"Output: {args.output}")
+        if split_size is None:
+            print(f"Output: {args.output}")
+        else:
+            output = Path(args.output)
+            print(f"Output: {output.with_name(output.stem + '_NNN' + output.suffix)}")
         print(f"Games written: {games_written}")
+        if prune is not None:
+            print(f"Lines dropped: {prune.duplicates} duplicates, {prune.subsumed} prefixes of longer lines")
+        if cache is not None:
+            print(f"Cache: {cache.hits} games reused, {cache.misses} expanded")
+        if args.max_lines is not None and games_written >= args.max_lines:
+            print(f"Stopped at --max-lines {args.max_lines}")
         return 0
         
     except Exception as e:
@@ -3,11 +3,193 @@
 Filter PGN games by Elo difference between players.
 Streams the PGN file game by game — handles any size database.
 Interactive prompts with sensible defaults.
+
+Non-interactive mode: pass a JSON file of named filter specs with --specs and
+every spec is evaluated in a single scan, each writing to its own output:
+
+    filter_games.py games.pgn --specs queries.json
+
+where queries.json looks like
+
+    [
+      {"name": "diff200_club", "min_diff": 200, "elo_range": [1650, 1850]},
+      {"name": "diff400_blitz", "min_diff": 400, "speed": "blitz",
+       "output": "blitz_upsets.pgn", "outcome": "weaker_wins_or_draws"}
+    ]
+
+Supported spec keys (all optional except "name"):
+    min_diff, max_diff      Elo difference bounds (inclusive)
+    elo_range               [low, high] — at least one player in the range
+    min_elo, max_elo        both players at least / at most this rating
+    result                  "1-0", "0-1", "1/2-1/2" or a list of them
+    outcome                 "stronger_wins" or "weaker_wins_or_draws"
+    time_control            exact TimeControl value(s), e.g. "180+2"
+    speed                   "ultrabullet", "bullet", "blitz", "rapid", "classical"
+    date_from, date_to      "YYYY.MM.DD" bounds (inclusive, "??" read as 00)
+    eco                     code(s) or ranges, e.g. ["B20-B99", "C42"]
+    output                  output path (default: <name>.pgn next to the input)
+    sample                  keep a uniform random sample of this many matches
+    stratify                header tag (e.g. "Result") to balance the sample over,
+                            with at most 100 distinct values
+    opening                 classified opening name prefix(es), e.g. "Sicilian Defense"
+    opening_eco             classified ECO code(s) or ranges (ignores the ECO header)
+    sort_by                 order the output by these keys, e.g. ["-diff", "Date"]:
+                            diff, white_elo, black_elo, min_elo, max_elo or any
+                            header tag; "-" sorts descending, missing values last
 """
 
+import argparse
+import errno
+import hashlib
+import heapq
+import json
+import math
+import pickle
+import random
 import re
+import stat
+import string
+import struct
 import sys
 import os
+import tempfile
+import time
+from array import array
+from collections import OrderedDict
+
+
+RAW_HEADER_RE = re.compile(rb'\[(\w+)\s+"([^"]*)"\]')
+
+READ_BUFFER_SIZE = 1 << 20
+GAME_START_MARKER = b'\n[Event "'
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Movetext tokens: comments, variation brackets, NAGs, move numbers, SAN/results
+MOVETEXT_TOKEN_RE = re.compile(rb"\{[^}]*\}|;[^\n]*|[()]|\$\d+|\d+\.+|[^\s(){};$]+")
+RESULT_TOKENS = frozenset((b"1-0", b"0-1", b"1/2-1/2", b"*"))
+
+POSITION_INDEX_MAGIC = b"PGNZIDX1"
+POSITION_INDEX_HEADER = struct.Struct("<8sIQQ")  # magic, plies, source size, records
+POSITION_RECORD = struct.Struct("<QQ")  # zobrist hash, game start offset
+DEFAULT_INDEX_PLIES = 30
+
+# Headers that identify a game across sources (Event/Site naming varies)
+DEDUPE_HEADERS = ("White", "Black", "Date", "Round", "Result")
+GAME_INFO_TAGS = ("WhiteElo", "BlackElo")  # always read by GameInfo
+DEFAULT_DEDUPE_MEMORY_MB = 256
+DEDUPE_BATCH_SIZE = 100000
+
+# Player index: <input>.pidx/{games.bin, names.txt, postings.bin, meta.json}
+GAME_RECORD = struct.Struct("<QQHHB")  # start, end, white Elo, black Elo, result code
+RESULT_CODES = {"1-0": 1, "0-1": 2, "1/2-1/2": 3}
+RESULT_NAMES = {code: result for result, code in RESULT_CODES.items()}
+
+STATS_BATCH_SIZE = 1 << 20
+DEFAULT_DIFF_BUCKET = 50
+DEFAULT_RATING_BAND = 200
+MAX_STATS_DIFF = 1000  # larger differences share the last bucket
+
+MAX_SAMPLE_STRATA = 100  # reservoirs of k records each
+
+DEFAULT_SORT_RUN_RECORDS = 1000000
+SORT_BATCH_RECORDS = 10000
+NUMERIC_SORT_KEYS = {
+    "diff": lambda g: g.diff,
+    "white_elo": lambda g: g.white_elo,
+    "black_elo": lambda g: g.black_elo,
+    "min_elo": lambda g: None if g.diff is None else min(g.white_elo, g.black_elo),
+    "max_elo": lambda g: None if g.diff is None else max(g.white_elo, g.black_elo),
+}
+
+# Fallback opening table (lichess chess-openings TSV layout: eco, name, pgn).
+# Use --eco-table with the full a.tsv ... e.tsv files for complete coverage.
+BUILTIN_ECO_TABLE = """\
+A00\tPolish Opening\t1. b4
+A01\tNimzo-Larsen Attack\t1. b3
+A02\tBird Opening\t1. f4
+A04\tZukertort Opening\t1. Nf3
+A09\tReti Opening\t1. Nf3 d5 2. c4
+A10\tEnglish Opening\t1. c4
+A20\tEnglish Opening: King's English Variation\t1. c4 e5
+A30\tEnglish Opening: Symmetrical Variation\t1. c4 c5
+A40\tQueen's Pawn Game\t1. d4
+A43\tBenoni Defense: Old Benoni\t1. d4 c5
+A45\tIndian Defense\t1. d4 Nf6
+A46\tIndian Defense: Knights Variation\t1. d4 Nf6 2. Nf3
+A51\tIndian Defense: Budapest Defense\t1. d4 Nf6 2. c4 e5
+A56\tBenoni Defense\t1. d4 Nf6 2. c4 c5
+A57\tBenko Gambit\t1. d4 Nf6 2. c4 c5 3. d5 b5
+A80\tDutch Defense\t1. d4 f5
+B00\tKing's Pawn Game\t1. e4
+B00\tNimzowitsch Defense\t1. e4 Nc6
+B01\tScandinavian Defense\t1. e4 d5
+B02\tAlekhine Defense\t1. e4 Nf6
+B06\tModern Defense\t1. e4 g6
+B07\tPirc Defense\t1. e4 d6 2. d4 Nf6
+B10\tCaro-Kann Defense\t1. e4 c6
+B20\tSicilian Defense\t1. e4 c5
+B22\tSicilian Defense: Alapin Variation\t1. e4 c5 2. c3
+B23\tSicilian Defense: Closed\t1. e4 c5 2. Nc3
+B27\tSicilian Defense\t1. e4 c5 2. Nf3
+B30\tSicilian Defense: Old Sicilian\t1. e4 c5 2. Nf3 Nc6
+B40\tSicilian Defense: French Variation\t1. e4 c5 2. Nf3 e6
+B50\tSicilian Defense\t1. e4 c5 2. Nf3 d6
+B70\tSicilian Defense: Dragon Variation\t1. e4 c5 2. Nf3 d6 3. d4 cxd4 4. Nxd4 Nf6 5. Nc3 g6
+B90\tSicilian Defense: Najdorf Variation\t1. e4 c5 2. Nf3 d6 3. d4 cxd4 4. Nxd4 Nf6 5. Nc3 a6
+C00\tFrench Defense\t1. e4 e6
+C02\tFrench Defense: Advance Variation\t1. e4 e6 2. d4 d5 3. e5
+C03\tFrench Defense: Tarrasch Variation\t1. e4 e6 2. d4 d5 3. Nd2
+C10\tFrench Defense: Paulsen Variation\t1. e4 e6 2. d4 d5 3. Nc3
+C20\tKing's Pawn Game\t1. e4 e5
+C21\tCenter Game\t1. e4 e5 2. d4
+C23\tBishop's Opening\t1. e4 e5 2. Bc4
+C25\tVienna Game\t1. e4 e5 2. Nc3
+C30\tKing's Gambit\t1. e4 e5 2. f4
+C40\tKing's Knight Opening\t1. e4 e5 2. Nf3
+C41\tPhilidor Defense\t1. e4 e5 2. Nf3 d6
+C42\tRussian Game\t1. e4 e5 2. Nf3 Nf6
+C44\tKing's Knight Opening: Normal Variation\t1. e4 e5 2. Nf3 Nc6
+C44\tScotch Game\t1. e4 e5 2. Nf3 Nc6 3. d4
+C46\tThree Knights Opening\t1. e4 e5 2. Nf3 Nc6 3. Nc3
+C47\tFour Knights Game\t1. e4 e5 2. Nf3 Nc6 3. Nc3 Nf6
+C50\tItalian Game\t1. e4 e5 2. Nf3 Nc6 3. Bc4
+C50\tItalian Game: Giuoco Piano\t1. e4 e5 2. Nf3 Nc6 3. Bc4 Bc5
+C51\tItalian Game: Evans Gambit\t1. e4 e5 2. Nf3 Nc6 3. Bc4 Bc5 4. b4
+C55\tItalian Game: Two Knights Defense\t1. e4 e5 2. Nf3 Nc6 3. Bc4 Nf6
+C60\tRuy Lopez\t1. e4 e5 2. Nf3 Nc6 3. Bb5
+C65\tRuy Lopez: Berlin Defense\t1. e4 e5 2. Nf3 Nc6 3. Bb5 Nf6
+C68\tRuy Lopez: Exchange Variation\t1. e4 e5 2. Nf3 Nc6 3. Bb5 a6 4. Bxc6
+C70\tRuy Lopez: Morphy Defense\t1. e4 e5 2. Nf3 Nc6 3. Bb5 a6
+D00\tQueen's Pawn Game\t1. d4 d5
+D00\tQueen's Pawn Game: London System\t1. d4 d5 2. Bf4
+D06\tQueen's Gambit\t1. d4 d5 2. c4
+D10\tSlav Defense\t1. d4 d5 2. c4 c6
+D20\tQueen's Gambit Accepted\t1. d4 d5 2. c4 dxc4
+D30\tQueen's Gambit Declined\t1. d4 d5 2. c4 e6
+D80\tGrunfeld Defense\t1. d4 Nf6 2. c4 g6 3. Nc3 d5
+E00\tIndian Defense\t1. d4 Nf6 2. c4 e6
+E01\tCatalan Opening\t1. d4 Nf6 2. c4 e6 3. g3
+E10\tIndian Defense\t1. d4 Nf6 2. c4 e6 3. Nf3
+E12\tQueen's Indian Defense\t1. d4 Nf6 2. c4 e6 3. Nf3 b6
+E20\tNimzo-Indian Defense\t1. d4 Nf6 2. c4 e6 3. Nc3 Bb4
+E60\tKing's Indian Defense\t1. d4 Nf6 2. c4 g6
+"""
+
+DEFAULT_PROGRESS_INTERVAL = 10  # seconds
+DEFAULT_CHECKPOINT_INTERVAL = 60  # seconds
+CHECKPOINT_CHECK_GAMES = 1000  # games between clock checks
+
+SHARD_BUFFER_SIZE = 256 << 10
+SHARD_BUFFER_TOTAL = 64 << 20  # all open shards together
+UNSAFE_SHARD_CHARS_RE = re.compile(r"[^\w.+-]")
+
+SPEEDS = ("ultrabullet", "bullet", "blitz", "rapid", "classical")
+
+SPEC_KEYS = {
+    "name", "output", "min_diff", "max_diff", "elo_range", "min_elo", "max_elo",
+    "result", "outcome", "time_control", "speed", "date_from", "date_to", "eco",
+    "sample", "stratify", "sort_by", "opening", "opening_eco",
+}
 
 
 def prompt(message, default=None):
@@ -18,27 +200,1678 @@ def prompt(message, default=None):
     return input(f"{message}: ").strip()
 
 
-def parse_header(game_lines, tag):
-    """Extract a header value from a list of game lines."""
-    for line in game_lines:
-        if line.startswith(f'[{tag} "'):
-            match = re.search(rf'\[{tag}\s+"([^"]*)"\]', line)
-            if match:
-                return match.group(1)
-        # Headers are at the top; stop once we hit a non-header line
-        if not line.startswith("[") and line.strip():
-            break
-    return None
+def header_prefixes(tags):
+    """Raw line prefixes of the given header tags, for parse_raw_headers(only=...)."""
+    return tuple(b"[" + tag.encode("ascii") + sep for tag in sorted(tags) for sep in (b" ", b"\t"))
+
+
+def parse_raw_headers(raw_lines, only=None):
+    """
+    Extract the header tags of the raw byte lines yielded by scan_games into
+    a dict. With `only` (from header_prefixes), other tags are skipped
+    without being matched or decoded, and parsing stops once all of the
+    requested tags are found.
+    """
+    headers = {}
+    wanted = len(only) // 2 if only is not None else -1  # space and tab prefix per tag
+    for line in raw_lines:
+        if not line.startswith(b"["):
+            if line.strip():
+                break
+            continue
+        if only is not None and not line.startswith(only):
+            continue
+        match = RAW_HEADER_RE.match(line)
+        if match:
+            headers[match.group(1).decode("ascii")] = match.group(2).decode("utf-8", "replace")
+            if len(headers) == wanted:
+                break
+    return headers
 
 
-def get_elo(game_lines, color):
-    """Get Elo rating for White or Black. Returns None if missing/invalid."""
-    val = parse_header(game_lines, f"{color}Elo")
+def header_elo(headers, color):
+    """Get Elo rating for White or Black from a header dict."""
+    val = headers.get(f"{color}Elo")
     if val and val.isdigit():
         return int(val)
     return None
 
 
+def time_control_speed(time_control):
+    """
+    Classify a TimeControl value ("180+2") into a speed category.
+    Uses the lichess estimate: base seconds + 40 * increment.
+    Returns None for missing or non-standard values ("-", "?", "40/7200").
+    """
+    if not time_control:
+        return None
+    base, _, inc = time_control.partition("+")
+    if not base.isdigit() or (inc and not inc.isdigit()):
+        return None
+    total = int(base) + 40 * int(inc or 0)
+    if total < 30:
+        return "ultrabullet"
+    if total < 180:
+        return "bullet"
+    if total < 480:
+        return "blitz"
+    if total < 1500:
+        return "rapid"
+    return "classical"
+
+
+def stronger_player_won(w_elo, b_elo, result):
+    """True when the higher-rated player won the game."""
+    return (w_elo > b_elo and result == "1-0") or (b_elo > w_elo and result == "0-1")
+
+
+class GameInfo:
+    """
+    Header fields of one game, parsed once and shared by every predicate.
+    The opening is classified from the movetext only when first asked for.
+    """
+
+    __slots__ = ("headers", "white_elo", "black_elo", "diff", "raw_lines", "classifier", "_opening")
+
+    def __init__(self, headers, raw_lines=None, classifier=None):
+        self.headers = headers
+        self.white_elo = header_elo(headers, "White")
+        self.black_elo = header_elo(headers, "Black")
+        if self.white_elo is None or self.black_elo is None:
+            self.diff = None
+        else:
+            self.diff = abs(self.white_elo - self.black_elo)
+        self.raw_lines = raw_lines
+        self.classifier = classifier
+        self._opening = False
+
+    @property
+    def opening(self):
+        """(eco, name) of the deepest known opening the game follows, or None."""
+        if self._opening is False:
+            classifier = self.classifier or opening_classifier()
+            self._opening = classifier.classify(raw_movetext(self.raw_lines or []))
+        return self._opening
+
+
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+def _eco_matcher(patterns):
+    """Build a matcher for ECO codes given exact codes and "A00-A39" ranges."""
+    exact = set()
+    ranges = []
+    for pattern in _as_list(patterns):
+        pattern = pattern.strip().upper()
+        if "-" in pattern:
+            low, high = (p.strip() for p in pattern.split("-", 1))
+            ranges.append((low, high))
+        else:
+            exact.add(pattern)
+
+    def match(eco):
+        if eco in exact:
+            return True
+        return any(low <= eco <= high for low, high in ranges)
+
+    return match
+
+
+def compile_spec(spec):
+    """
+    Compile a filter spec dict into (predicate over GameInfo, header tags it
+    reads besides GAME_INFO_TAGS).
+
+    All parsing and validation happens here, once per spec; the returned
+    predicate is a short chain of closures over plain ints, sets and strings.
+    """
+    unknown = set(spec) - SPEC_KEYS
+    if unknown:
+        raise ValueError(f"spec {spec.get('name')!r}: unknown keys {sorted(unknown)}")
+
+    checks = []
+    tags = set()
+    needs_elo = False
+
+    if "min_diff" in spec:
+        min_diff = int(spec["min_diff"])
+        needs_elo = True
+        checks.append(lambda g: g.diff >= min_diff)
+    if "max_diff" in spec:
+        max_diff = int(spec["max_diff"])
+        needs_elo = True
+        checks.append(lambda g: g.diff <= max_diff)
+    if "elo_range" in spec:
+        elo_low, elo_high = (int(v) for v in spec["elo_range"])
+        needs_elo = True
+        checks.append(lambda g: elo_low <= g.white_elo <= elo_high or elo_low <= g.black_elo <= elo_high)
+    if "min_elo" in spec:
+        min_elo = int(spec["min_elo"])
+        needs_elo = True
+        checks.append(lambda g: g.white_elo >= min_elo and g.black_elo >= min_elo)
+    if "max_elo" in spec:
+        max_elo = int(spec["max_elo"])
+        needs_elo = True
+        checks.append(lambda g: g.white_elo <= max_elo and g.black_elo <= max_elo)
+    if "outcome" in spec:
+        outcome = spec["outcome"]
+        if outcome not in ("stronger_wins", "weaker_wins_or_draws"):
+            raise ValueError(f"spec {spec.get('name')!r}: unknown outcome {outcome!r}")
+        want_strong = outcome == "stronger_wins"
+        needs_elo = True
+        tags.add("Result")
+        checks.append(
+            lambda g: stronger_player_won(g.white_elo, g.black_elo, g.headers.get("Result")) == want_strong
+        )
+    if "result" in spec:
+        results = frozenset(_as_list(spec["result"]))
+        tags.add("Result")
+        checks.append(lambda g: g.headers.get("Result") in results)
+    if "time_control" in spec:
+        time_controls = frozenset(_as_list(spec["time_control"]))
+        tags.add("TimeControl")
+        checks.append(lambda g: g.headers.get("TimeControl") in time_controls)
+    if "speed" in spec:
+        speeds = frozenset(_as_list(spec["speed"]))
+        bad = speeds - set(SPEEDS)
+        if bad:
+            raise ValueError(f"spec {spec.get('name')!r}: unknown speed {sorted(bad)}")
+        tags.add("TimeControl")
+        checks.append(lambda g: time_control_speed(g.headers.get("TimeControl")) in speeds)
+    if "date_from" in spec:
+        date_from = spec["date_from"].replace("?", "0")
+        tags.add("Date")
+        checks.append(lambda g: g.headers.get("Date", "").replace("?", "0") >= date_from)
+    if "date_to" in spec:
+        date_to = spec["date_to"].replace("?", "0")
+        tags.add("Date")
+        checks.append(lambda g: "" < g.headers.get("Date", "").replace("?", "0") <= date_to)
+    if "eco" in spec:
+        eco_match = _eco_matcher(spec["eco"])
+        tags.add("ECO")
+        checks.append(lambda g: eco_match(g.headers.get("ECO", "").upper()))
+    if "opening_eco" in spec:
+        opening_eco_match = _eco_matcher(spec["opening_eco"])
+        checks.append(lambda g: g.opening is not None and opening_eco_match(g.opening[0]))
+    if "opening" in spec:
+        prefixes = tuple(name.casefold() for name in _as_list(spec["opening"]))
+        checks.append(lambda g: g.opening is not None and g.opening[1].casefold().startswith(prefixes))
+
+    if needs_elo:
+        # Elo checks assume both ratings are present; reject the rest up front
+        checks.insert(0, lambda g: g.diff is not None)
+
+    if not checks:
+        return (lambda g: True), tags
+    if len(checks) == 1:
+        return checks[0], tags
+    checks = tuple(checks)
+
+    def predicate(g):
+        for check in checks:
+            if not check(g):
+                return False
+        return True
+
+    return predicate, tags
+
+
+def load_specs(spec_path):
+    """Load a JSON list of named filter specs."""
+    with open(spec_path, "r", encoding="utf-8") as f:
+        specs = json.load(f)
+    if not isinstance(specs, list):
+        raise ValueError("spec file must contain a JSON list of filter specs")
+    names = set()
+    for spec in specs:
+        name = spec.get("name")
+        if not name:
+            raise ValueError("every filter spec needs a \"name\"")
+        if name in names:
+            raise ValueError(f"duplicate spec name {name!r}")
+        names.add(name)
+    return specs
+
+
+def eof_padding(src_fd, src_size):
+    """Newlines needed after the last game so it is separated like the others."""
+    tail = os.pread(src_fd, min(src_size, 2), max(src_size - 2, 0))
+    if tail.endswith(b"\n\n") or not tail:
+        return b""
+    return b"\n" if tail.endswith(b"\n") else b"\n\n"
+
+
+class RangeWriter:
+    """
+    Copy byte ranges of the source PGN straight into an output file.
+
+    Adjacent ranges are coalesced into a single copy. Regular-file outputs
+    use os.copy_file_range so the bytes never enter Python; anything else
+    (pipes, or kernels/filesystems without support) goes through pread and
+    large buffered binary writes.
+
+    With append=True an existing file is extended rather than truncated;
+    copy=False forces the buffered path (better for many small scattered
+    writes, where one syscall per game would dominate).
+    """
+
+    def __init__(self, src_fd, src_size, path, eof_pad=b"", buffer_size=WRITE_BUFFER_SIZE,
+                 append=False, copy=True):
+        self.src_fd = src_fd
+        self.src_size = src_size
+        self.path = path
+        self.eof_pad = eof_pad
+        self.buffer_size = buffer_size
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | (0 if append else os.O_TRUNC), 0o666)
+        if append:
+            os.lseek(self.fd, 0, os.SEEK_END)
+        self.use_copy = copy and hasattr(os, "copy_file_range") and stat.S_ISREG(os.fstat(self.fd).st_mode)
+        self.buffer = bytearray()
+        self.run_start = None
+        self.run_end = None
+
+    def add(self, start, end):
+        """Queue the source bytes [start, end) for output."""
+        if self.run_end == start:
+            self.run_end = end
+            return
+        self._write_run()
+        self.run_start = start
+        self.run_end = end
+
+    def _write_run(self):
+        if self.run_start is None:
+            return
+        start, end = self.run_start, self.run_end
+        self.run_start = self.run_end = None
+
+        if self.use_copy:
+            self._flush_buffer()
+            try:
+                while start < end:
+                    copied = os.copy_file_range(self.src_fd, self.fd, end - start, start)
+                    if copied == 0:
+                        break
+                    start += copied
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                self.use_copy = False
+
+        while start < end:
+            chunk = os.pread(self.src_fd, min(end - start, self.buffer_size), start)
+            if not chunk:
+                break
+            start += len(chunk)
+            self.buffer += chunk
+            if len(self.buffer) >= self.buffer_size:
+                self._flush_buffer()
+
+        if end == self.src_size and self.eof_pad:
+            self.buffer += self.eof_pad
+
+    def _flush_buffer(self):
+        view = memoryview(self.buffer)
+        while view:
+            written = os.write(self.fd, view)
+            view = view[written:]
+        view.release()
+        del self.buffer[:]
+
+    def flush(self):
+        """Write out everything queued so far."""
+        self._write_run()
+        self._flush_buffer()
+
+    def size(self):
+        """Bytes in the output file after a flush."""
+        self.flush()
+        return os.lseek(self.fd, 0, os.SEEK_CUR)
+
+    def sync(self):
+        self.flush()
+        os.fsync(self.fd)
+
+    def truncate(self, size):
+        """Cut the output back to `size` bytes and continue writing from there."""
+        self.flush()
+        os.ftruncate(self.fd, size)
+        os.lseek(self.fd, size, os.SEEK_SET)
+
+    def close(self):
+        self.flush()
+        os.close(self.fd)
+
+
+def normalise_name(value):
+    """Case- and whitespace-insensitive form of a player name ("Carlsen,Magnus")."""
+    return " ".join(value.replace(",", ", ").split()).casefold()
+
+
+def game_fingerprint(headers, raw_lines):
+    """
+    128-bit digest identifying a game independently of its source: the
+    identifying headers, case/space-normalised, plus the mainline moves
+    (comments, clock annotations and variations are ignored).
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for tag in DEDUPE_HEADERS:
+        h.update(normalise_name(headers.get(tag, "")).encode("utf-8"))
+        h.update(b"\0")
+    h.update(b" ".join(mainline_sans(raw_movetext(raw_lines))))
+    return h.digest()
+
+
+class GameDeduplicator:
+    """
+    Streaming duplicate detector with bounded memory.
+
+    A Bloom filter answers "definitely new" for almost every game without
+    touching disk. Every fingerprint is also recorded in an on-disk SQLite
+    table (inserted in batches), which is consulted only on Bloom hits so
+    false positives never drop a unique game.
+    """
+
+    def __init__(self, work_dir, expected_games, memory_mb=DEFAULT_DEDUPE_MEMORY_MB):
+        import sqlite3
+
+        self.num_bits = max(memory_mb, 1) * 8 * 1024 * 1024
+        self.bits = bytearray(self.num_bits // 8)
+        per_item = self.num_bits / max(expected_games, 1)
+        self.num_hashes = min(max(round(per_item * math.log(2)), 1), 16)
+
+        fd, self.db_path = tempfile.mkstemp(suffix=".dedupe.sqlite", dir=work_dir)
+        os.close(fd)
+        self.db = sqlite3.connect(self.db_path)
+        self.db.execute("PRAGMA journal_mode=OFF")
+        self.db.execute("PRAGMA synchronous=OFF")
+        self.db.execute("CREATE TABLE seen (digest BLOB PRIMARY KEY) WITHOUT ROWID")
+        self.pending = set()
+
+        self.duplicates = 0
+        self.exact_checks = 0
+
+    def _bit_positions(self, digest):
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def is_duplicate(self, digest):
+        """Record a fingerprint; True if it was seen before."""
+        positions = self._bit_positions(digest)
+        bits = self.bits
+        maybe_seen = all(bits[p >> 3] & (1 << (p & 7)) for p in positions)
+
+        if maybe_seen:
+            self.exact_checks += 1
+            if digest in self.pending or self.db.execute(
+                "SELECT 1 FROM seen WHERE digest = ?", (digest,)
+            ).fetchone():
+                self.duplicates += 1
+                return True
+        else:
+            for p in positions:
+                bits[p >> 3] |= 1 << (p & 7)
+
+        self.pending.add(digest)
+        if len(self.pending) >= DEDUPE_BATCH_SIZE:
+            self._flush()
+        return False
+
+    def _flush(self):
+        self.db.executemany("INSERT INTO seen VALUES (?)", ((d,) for d in self.pending))
+        self.db.commit()
+        self.pending.clear()
+
+    def close(self):
+        self.db.close()
+        os.remove(self.db_path)
+
+
+class ReservoirSampler:
+    """
+    Uniform random sample of at most k game spans from a stream (Algorithm R).
+
+    With `stratify`, one reservoir of k is kept per value of that header tag
+    and the final sample takes an equal share from each (unused share of a
+    small stratum goes to the others), so e.g. wins, losses and draws end up
+    balanced. Only (start, end) offsets are held, at most k per stratum; a
+    tag with more than MAX_SAMPLE_STRATA values raises ValueError.
+    """
+
+    def __init__(self, k, stratify=None, rng=None):
+        self.k = k
+        self.stratify = stratify
+        self.rng = rng or random.Random()
+        self.reservoirs = {}
+        self.seen = {}
+
+    def add(self, record, headers):
+        """Offer one record — a (start, end) span, or a (sort key, start, end) triple."""
+        key = headers.get(self.stratify, "?") if self.stratify else None
+        reservoir = self.reservoirs.get(key)
+        if reservoir is None:
+            if len(self.reservoirs) >= MAX_SAMPLE_STRATA:
+                raise ValueError(f"cannot stratify on {self.stratify}: more than {MAX_SAMPLE_STRATA} "
+                                 f"distinct values (use a tag with fewer, such as Result)")
+            reservoir = self.reservoirs[key] = []
+        seen = self.seen.get(key, 0) + 1
+        self.seen[key] = seen
+        if len(reservoir) < self.k:
+            reservoir.append(record)
+        else:
+            j = self.rng.randrange(seen)
+            if j < self.k:
+                reservoir[j] = record
+
+    def selected(self):
+        """The sampled records, sorted (file order for plain spans)."""
+        strata = sorted(self.reservoirs.values(), key=len)
+        remaining = self.k
+        chosen = []
+        for i, reservoir in enumerate(strata):
+            share = remaining // (len(strata) - i)
+            picked = reservoir if len(reservoir) <= share else self.rng.sample(reservoir, share)
+            chosen.extend(picked)
+            remaining -= len(picked)
+        chosen.sort()
+        return chosen
+
+
+def compile_sort_key(fields):
+    """
+    Compile sort fields ("-diff", "Date") into a function GameInfo -> key
+    tuple. Every component is (missing flag, value) so missing values sort
+    last; descending strings are stored as inverted UTF-8 bytes, which keeps
+    keys plain comparable tuples for the external merge.
+    """
+    getters = []
+    for field in _as_list(fields):
+        descending = field.startswith("-")
+        name = field.lstrip("-+")
+        if not name:
+            raise ValueError(f"empty sort field in {fields!r}")
+        numeric = NUMERIC_SORT_KEYS.get(name)
+        if numeric:
+            sign = -1 if descending else 1
+            getters.append(lambda g, get=numeric, sign=sign: (
+                (1, 0) if get(g) is None else (0, sign * get(g))
+            ))
+        elif descending:
+            getters.append(lambda g, tag=name: (
+                (1, b"") if tag not in g.headers
+                else (0, bytes(255 - c for c in g.headers[tag].encode("utf-8") + b"\0"))
+            ))
+        else:
+            getters.append(lambda g, tag=name: (
+                (1, b"") if tag not in g.headers else (0, g.headers[tag].encode("utf-8") + b"\0")
+            ))
+    getters = tuple(getters)
+    return lambda g: tuple(get(g) for get in getters)
+
+
+def sort_key_tags(fields):
+    """Header tags read by compile_sort_key(fields), besides GAME_INFO_TAGS."""
+    names = (field.lstrip("-+") for field in _as_list(fields))
+    return {name for name in names if name and name not in NUMERIC_SORT_KEYS}
+
+
+class ExternalSorter:
+    """
+    Sort (key, start, end) records of any number of games in fixed memory.
+
+    Records are buffered up to run_records, sorted and spilled as a pickled
+    run file; sorted() k-way merges the runs (plus the in-memory tail) with
+    heapq.merge, reading each run in small batches.
+    """
+
+    def __init__(self, work_dir, run_records=DEFAULT_SORT_RUN_RECORDS):
+        self.work_dir = work_dir
+        self.run_records = run_records
+        self.buffer = []
+        self.runs = []
+
+    def add(self, record):
+        self.buffer.append(record)
+        if len(self.buffer) >= self.run_records:
+            self._spill()
+
+    def _spill(self):
+        self.buffer.sort()
+        fd, path = tempfile.mkstemp(suffix=".sortrun", dir=self.work_dir)
+        self.runs.append(path)
+        with os.fdopen(fd, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+            for i in range(0, len(self.buffer), SORT_BATCH_RECORDS):
+                pickle.dump(self.buffer[i:i + SORT_BATCH_RECORDS], f, pickle.HIGHEST_PROTOCOL)
+        self.buffer = []
+
+    @staticmethod
+    def _read_run(path):
+        with open(path, "rb", buffering=READ_BUFFER_SIZE) as f:
+            while True:
+                try:
+                    yield from pickle.load(f)
+                except EOFError:
+                    return
+
+    def sorted(self):
+        """Yield all records in key order."""
+        self.buffer.sort()
+        if not self.runs:
+            yield from self.buffer
+            return
+        yield from heapq.merge(self.buffer, *(self._read_run(path) for path in self.runs))
+
+    def close(self):
+        for path in self.runs:
+            os.remove(path)
+        self.runs = []
+        self.buffer = []
+
+
+class ScanCheckpoint:
+    """
+    Periodic record of how far a run_filters scan has got: the input offset
+    of the next game, the size of every output at that point and the counts
+    so far. It is only valid for the same input file and specs, which are
+    fingerprinted into it. Outputs are fsynced before each save so the
+    recorded sizes are never ahead of the data on disk.
+    """
+
+    def __init__(self, path, pgn_path, specs, interval=DEFAULT_CHECKPOINT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        identity = {
+            "input": os.path.abspath(pgn_path),
+            "input_size": os.path.getsize(pgn_path),
+            "specs": specs,
+        }
+        self.fingerprint = hashlib.sha256(json.dumps(identity, sort_keys=True).encode("utf-8")).hexdigest()
+        self.last_save = time.monotonic()
+
+    def load(self):
+        """The saved state for this scan, or None to start from scratch."""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if state.get("fingerprint") != self.fingerprint:
+            print(f"  (ignoring checkpoint {self.path}: it belongs to a different input or filter set)")
+            return None
+        return state
+
+    def due(self):
+        return time.monotonic() - self.last_save >= self.interval
+
+    def save(self, offset, writers, summary):
+        for writer in writers.values():
+            writer.sync()
+        state = {
+            "fingerprint": self.fingerprint,
+            "offset": offset,
+            "outputs": {path: writer.size() for path, writer in writers.items()},
+            "total": summary.total,
+            "skipped_no_elo": summary.skipped_no_elo,
+            "matched": summary.matched,
+        }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.last_save = time.monotonic()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ScanMetrics:
+    """
+    Throughput counters for a scan: games, bytes and matches, plus the wall
+    time spent reading (the scanner), parsing headers, evaluating predicates
+    and writing output. Prints a progress line every `interval` seconds and
+    can dump a final JSON summary for comparing storage and CPU bottlenecks.
+    """
+
+    STAGES = ("read", "parse", "predicate", "write")
+
+    def __init__(self, interval=DEFAULT_PROGRESS_INTERVAL):
+        self.interval = interval
+        self.started = time.perf_counter()
+        self.next_report = self.started + interval
+        self.games = 0
+        self.bytes = 0
+        self.matched = 0
+        self.read = 0.0
+        self.parse = 0.0
+        self.predicate = 0.0
+        self.write = 0.0
+        self.finished = None
+
+    def tick(self, now):
+        """Called once per game with the current perf_counter time."""
+        if now >= self.next_report:
+            self.report(now)
+            self.next_report = now + self.interval
+
+    def finish(self):
+        self.finished = time.perf_counter()
+
+    def summary(self, now=None):
+        now = now or self.finished or time.perf_counter()
+        elapsed = max(now - self.started, 1e-9)
+        stages = {stage: getattr(self, stage) for stage in self.STAGES}
+        stages["other"] = max(elapsed - sum(stages.values()), 0.0)
+        return {
+            "elapsed_s": round(elapsed, 3),
+            "games": self.games,
+            "bytes": self.bytes,
+            "matched": self.matched,
+            "games_per_s": round(self.games / elapsed, 1),
+            "mb_per_s": round(self.bytes / elapsed / 1e6, 2),
+            "match_rate": round(self.matched / self.games, 4) if self.games else 0.0,
+            "stage_s": {stage: round(seconds, 3) for stage, seconds in stages.items()},
+        }
+
+    def report(self, now=None):
+        s = self.summary(now)
+        split = " ".join(
+            f"{stage} {100 * seconds / s['elapsed_s']:.0f}%" for stage, seconds in s["stage_s"].items()
+        )
+        print(f"  ...{s['games']} games, {s['mb_per_s']:.1f} MB/s, {s['games_per_s']:.0f} games/s, "
+              f"{100 * s['match_rate']:.1f}% matched | {split}")
+
+    def write_json(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+class FilterSummary:
+    """Counts from one run_filters scan."""
+
+    def __init__(self, names):
+        self.total = 0
+        self.skipped_no_elo = 0
+        self.matched = {name: 0 for name in names}
+        self.saved = {}
+
+
+def run_filters(pgn_path, specs, out_dir, dedupe=None, spans=None, seed=None,
+                sort_run_records=DEFAULT_SORT_RUN_RECORDS, classifier=None, checkpoint=None, metrics=None):
+    """
+    Evaluate every spec against each game in a single scan.
+    Matched games are copied out as raw byte ranges of the input; specs with
+    "sample" keep a reservoir of offsets and specs with "sort_by" an
+    ExternalSorter of (key, offsets) records, written after the scan.
+    With a GameDeduplicator, repeated games are dropped before filtering.
+    With `spans` (e.g. from the player index), only those games are read.
+    `classifier` is the OpeningClassifier for opening specs (default: built-in).
+    With a ScanCheckpoint, progress is saved periodically and a matching
+    earlier checkpoint is resumed: outputs are cut back to their recorded
+    sizes and the scan continues from the recorded offset.
+    Progress and stage timings go to `metrics` (a ScanMetrics).
+    Returns a FilterSummary.
+    """
+    metrics = metrics or ScanMetrics()
+    compiled = []
+    tags = set(GAME_INFO_TAGS)
+    for spec in specs:
+        output = spec.get("output") or f"{spec['name']}.pgn"
+        if not os.path.isabs(output):
+            output = os.path.join(out_dir, output)
+        predicate, spec_tags = compile_spec(spec)
+        tags |= spec_tags
+        if spec.get("sample") and spec.get("stratify"):
+            tags.add(spec["stratify"])
+        if spec.get("sort_by"):
+            tags |= sort_key_tags(spec["sort_by"])
+        compiled.append((spec, predicate, output))
+    if dedupe:
+        tags.update(DEDUPE_HEADERS)
+    only = header_prefixes(tags)
+
+    deferred_outputs = [output for spec, _, output in compiled if spec.get("sample") or spec.get("sort_by")]
+    all_outputs = [output for _, _, output in compiled]
+    for output in deferred_outputs:
+        if all_outputs.count(output) > 1:
+            raise ValueError(f"sampled or sorted output {output} cannot be shared with another spec")
+    if checkpoint and (deferred_outputs or dedupe or spans is not None):
+        raise ValueError("checkpointing only works for full scans without sampling, sorting or dedupe")
+    state = checkpoint.load() if checkpoint else None
+
+    rng = random.Random(seed)
+    src_fd = os.open(pgn_path, os.O_RDONLY)
+    src_size = os.fstat(src_fd).st_size
+    pad = eof_padding(src_fd, src_size)
+    outputs = {}
+    summary = FilterSummary(spec["name"] for spec, _, _ in compiled)
+    counts = summary.matched
+    try:
+        targets = []
+        samplers = []
+        sorters = []
+        for spec, predicate, output in compiled:
+            sort_key = compile_sort_key(spec["sort_by"]) if spec.get("sort_by") else None
+            if spec.get("sample"):
+                sampler = ReservoirSampler(int(spec["sample"]), spec.get("stratify"), rng)
+                samplers.append((spec["name"], predicate, sampler, sort_key, output))
+                continue
+            if sort_key:
+                sorter = ExternalSorter(out_dir, sort_run_records)
+                sorters.append((spec["name"], predicate, sorter, sort_key, output))
+                continue
+            if output not in outputs:
+                outputs[output] = RangeWriter(src_fd, src_size, output, pad, append=state is not None)
+            targets.append((spec["name"], predicate, outputs[output]))
+
+        total = 0
+        skipped_no_elo = 0
+        matched_any = 0
+        resume_offset = 0
+
+        if state:
+            for output, writer in outputs.items():
+                writer.truncate(state["outputs"].get(output, 0))
+            resume_offset = state["offset"]
+            total = state["total"]
+            skipped_no_elo = state["skipped_no_elo"]
+            counts.update(state["matched"])
+            print(f"  Resuming after {total} games (byte {resume_offset} of {src_size})")
+
+        games = scan_games(pgn_path, resume_offset) if spans is None else read_games_at(pgn_path, spans)
+        clock = time.perf_counter
+        t = clock()
+        for start, end, raw_lines in games:
+            now = clock()
+            metrics.read += now - t
+            t = now
+            metrics.games += 1
+            metrics.bytes += end - start
+            metrics.tick(now)
+
+            total += 1
+            if checkpoint and total % CHECKPOINT_CHECK_GAMES == 0 and checkpoint.due():
+                summary.total, summary.skipped_no_elo = total - 1, skipped_no_elo
+                checkpoint.save(start, outputs, summary)
+
+            headers = parse_raw_headers(raw_lines, only)
+            if dedupe and dedupe.is_duplicate(game_fingerprint(headers, raw_lines)):
+                now = clock()
+                metrics.parse += now - t
+                t = now
+                continue
+
+            game = GameInfo(headers, raw_lines, classifier)
+            if game.diff is None:
+                skipped_no_elo += 1
+            now = clock()
+            metrics.parse += now - t
+            t = now
+
+            hit = False
+            hit_writers = []
+            for name, predicate, writer in targets:
+                if predicate(game):
+                    hit = True
+                    counts[name] += 1
+                    hit_writers.append(writer)
+            for name, predicate, sampler, sort_key, _ in samplers:
+                if predicate(game):
+                    hit = True
+                    counts[name] += 1
+                    sampler.add((sort_key(game), start, end) if sort_key else (start, end), headers)
+            for name, predicate, sorter, sort_key, _ in sorters:
+                if predicate(game):
+                    hit = True
+                    counts[name] += 1
+                    sorter.add((sort_key(game), start, end))
+            matched_any += hit
+            metrics.matched += hit
+            now = clock()
+            metrics.predicate += now - t
+            t = now
+
+            if hit_writers:
+                for writer in hit_writers:
+                    writer.add(start, end)
+                now = clock()
+                metrics.write += now - t
+                t = now
+
+        write_started = clock()
+        deferred = [(name, sampler.selected(), output) for name, _, sampler, _, output in samplers]
+        deferred += [(name, sorter.sorted(), output) for name, _, sorter, _, output in sorters]
+        for name, records, output in deferred:
+            writer = RangeWriter(src_fd, src_size, output, pad)
+            saved = 0
+            try:
+                for record in records:
+                    writer.add(record[-2], record[-1])
+                    saved += 1
+            finally:
+                writer.close()
+            summary.saved[name] = saved
+        for writer in outputs.values():
+            writer.flush()
+        metrics.write += clock() - write_started
+    finally:
+        for writer in outputs.values():
+            writer.close()
+        for _, _, sorter, _, _ in sorters:
+            sorter.close()
+        os.close(src_fd)
+        metrics.finish()
+
+    for name, _, _ in targets:
+        summary.saved[name] = counts[name]
+    summary.total = total
+    summary.skipped_no_elo = skipped_no_elo
+    if checkpoint:
+        checkpoint.remove()
+    return summary
+
+
+def scan_games(pgn_path, start=0, stop=None):
+    """
+    Yield (start, end, raw_lines) for each game in the file.
+
+    start/end are byte offsets delimiting the game in the source — from its
+    [Event line up to the next game's [Event line — and raw_lines are its
+    undecoded lines. Scanning begins at byte offset `start`, which must be a
+    line boundary, and games starting at or after `stop` are not yielded.
+
+    The file is read in large blocks and game boundaries are found with
+    bytes.find; offsets come from the block position, not from summing
+    line lengths.
+    """
+    marker = GAME_START_MARKER
+    overlap = len(marker) - 1
+    # A virtual newline before `start` lets a game begin on the first line
+    buf = b"\n"
+    base = start - 1  # file offset of buf[0]
+    game_start = None  # index in buf of the game being collected
+    search = 0
+
+    with open(pgn_path, "rb", buffering=0) as f:
+        f.seek(start)
+        while True:
+            block = f.read(READ_BUFFER_SIZE)
+            if not block:
+                break
+            buf += block
+            i = buf.find(marker, search)
+            while i >= 0:
+                boundary = i + 1
+                if game_start is not None:
+                    yield base + game_start, base + boundary, buf[game_start:boundary].splitlines(True)
+                if stop is not None and base + boundary >= stop:
+                    return
+                game_start = boundary
+                i = buf.find(marker, boundary)
+
+            # Keep the unfinished game, and enough of the tail to find a
+            # marker that straddles the next block
+            search = max(len(buf) - overlap, game_start or 0)
+            keep = search if game_start is None else game_start
+            buf = buf[keep:]
+            base += keep
+            search -= keep
+            if game_start is not None:
+                game_start = 0
+
+    if game_start is not None:
+        yield base + game_start, base + len(buf), buf[game_start:].splitlines(True)
+
+
+def raw_movetext(raw_lines):
+    """Join the movetext lines of a game (everything after the header block)."""
+    for i, line in enumerate(raw_lines):
+        if not line.startswith(b"[") and line.strip():
+            return b"".join(raw_lines[i:])
+    return b""
+
+
+def mainline_sans(movetext, limit=None):
+    """
+    Return the mainline SAN tokens of a movetext, skipping comments,
+    variations, NAGs, move numbers and the result. Annotation suffixes
+    ("!", "?!") are stripped. Stops after `limit` moves when given.
+    """
+    sans = []
+    depth = 0
+    for match in MOVETEXT_TOKEN_RE.finditer(movetext):
+        token = match.group()
+        first = token[:1]
+        if first == b"(":
+            depth += 1
+        elif first == b")":
+            depth = max(depth - 1, 0)
+        elif depth or first in b"{;$" or first.isdigit() and token.endswith(b"."):
+            continue
+        elif token in RESULT_TOKENS:
+            break
+        else:
+            sans.append(token.rstrip(b"!?"))
+            if limit is not None and len(sans) >= limit:
+                break
+    return sans
+
+
+class OpeningClassifier:
+    """
+    Classify games by matching their first mainline SAN tokens against a
+    trie of known openings — no board is replayed, so it runs at scan speed.
+    The deepest opening on the game's path wins, as in the lichess explorer.
+    """
+
+    def __init__(self):
+        self.root = {}
+        self.depth = 0
+
+    def add(self, eco, name, pgn):
+        node = self.root
+        sans = mainline_sans(pgn.encode("utf-8"))
+        for san in sans:
+            node = node.setdefault(san.rstrip(b"+#"), {})
+        node[None] = (eco, name)
+        self.depth = max(self.depth, len(sans))
+
+    def load_tsv(self, text):
+        """Add "eco<TAB>name<TAB>pgn" lines (lichess chess-openings format)."""
+        for line in text.splitlines():
+            parts = line.split("\t")
+            if len(parts) >= 3 and parts[0] != "eco":
+                self.add(parts[0].strip(), parts[1].strip(), parts[2])
+
+    def classify(self, movetext):
+        node = self.root
+        best = None
+        for san in mainline_sans(movetext, self.depth):
+            node = node.get(san.rstrip(b"+#"))
+            if node is None:
+                break
+            best = node.get(None, best)
+        return best
+
+
+_opening_classifiers = {}
+
+
+def opening_classifier(eco_tables=()):
+    """Cached OpeningClassifier from the built-in table plus any local TSV files."""
+    key = tuple(eco_tables)
+    classifier = _opening_classifiers.get(key)
+    if classifier is None:
+        classifier = OpeningClassifier()
+        classifier.load_tsv(BUILTIN_ECO_TABLE)
+        for path in eco_tables:
+            with open(path, "r", encoding="utf-8") as f:
+                classifier.load_tsv(f.read())
+        _opening_classifiers[key] = classifier
+    return classifier
+
+
+def game_spans_at(pgn_path, starts):
+    """Yield (start, end) of the games beginning at each of the given offsets."""
+    with open(pgn_path, "rb", buffering=READ_BUFFER_SIZE) as f:
+        for start in starts:
+            f.seek(start)
+            pos = start
+            for i, line in enumerate(f):
+                if i and line.startswith(b'[Event "'):
+                    break
+                pos += len(line)
+            yield start, pos
+
+
+def write_game_ranges(pgn_path, spans, output):
+    """Copy the given (start, end) game spans of pgn_path into output, in order."""
+    src_fd = os.open(pgn_path, os.O_RDONLY)
+    try:
+        src_size = os.fstat(src_fd).st_size
+        writer = RangeWriter(src_fd, src_size, output, eof_padding(src_fd, src_size))
+        try:
+            count = 0
+            for start, end in spans:
+                writer.add(start, end)
+                count += 1
+        finally:
+            writer.close()
+    finally:
+        os.close(src_fd)
+    return count
+
+
+def read_games_at(pgn_path, spans):
+    """Yield (start, end, raw_lines) like scan_games, for known game spans only."""
+    with open(pgn_path, "rb") as f:
+        for start, end in spans:
+            f.seek(start)
+            yield start, end, f.read(end - start).splitlines(keepends=True)
+
+
+def split_game_ranges(pgn_path, parts):
+    """
+    Split a PGN file into at most `parts` byte ranges, each starting on a
+    game boundary, for parallel scanning with scan_games(start, stop).
+    """
+    size = os.path.getsize(pgn_path)
+    bounds = [0]
+    with open(pgn_path, "rb") as f:
+        for i in range(1, parts):
+            target = max(size * i // parts, bounds[-1])
+            f.seek(target)
+            pos = target
+            if target:
+                pos += len(f.readline())  # skip the partial line
+            for line in f:
+                if line.startswith(b'[Event "'):
+                    break
+                pos += len(line)
+            else:
+                pos = size
+            if pos > bounds[-1]:
+                bounds.append(pos)
+    bounds.append(size)
+    return [(a, b) for a, b in zip(bounds, bounds[1:]) if b > a]
+
+
+def game_position_hashes(raw_lines, plies):
+    """Polyglot Zobrist hashes of the positions reached in a game's first plies."""
+    import chess
+    import chess.polyglot
+
+    headers = parse_raw_headers(raw_lines)
+    fen = headers.get("FEN")
+    try:
+        board = chess.Board(fen) if fen else chess.Board()
+    except ValueError:
+        return set()
+
+    # The standard start position would match every game; only index custom starts
+    hashes = {chess.polyglot.zobrist_hash(board)} if fen else set()
+    for san in mainline_sans(raw_movetext(raw_lines), plies):
+        try:
+            board.push_san(san.decode("ascii", "replace"))
+        except ValueError:
+            break
+        hashes.add(chess.polyglot.zobrist_hash(board))
+    return hashes
+
+
+def _index_range(task):
+    """Worker: index the games in one byte range into a sorted run file."""
+    pgn_path, start, stop, plies, run_dir = task
+    records = []
+    games = 0
+    for game_start, _, raw_lines in scan_games(pgn_path, start, stop):
+        games += 1
+        for h in game_position_hashes(raw_lines, plies):
+            records.append((h, game_start))
+    records.sort()
+
+    fd, run_path = tempfile.mkstemp(suffix=".run", dir=run_dir)
+    with os.fdopen(fd, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+        for record in records:
+            f.write(POSITION_RECORD.pack(*record))
+    return run_path, games, len(records)
+
+
+def _read_run(run_path, chunk_records=65536):
+    with open(run_path, "rb") as f:
+        while True:
+            chunk = f.read(POSITION_RECORD.size * chunk_records)
+            if not chunk:
+                return
+            yield from POSITION_RECORD.iter_unpack(chunk)
+
+
+def build_position_index(pgn_path, index_path, plies=DEFAULT_INDEX_PLIES, jobs=None):
+    """
+    Build a Zobrist position index: a sorted array of (hash, game offset)
+    records for every position in the first `plies` plies of each game.
+
+    The file is split on game boundaries and indexed in a process pool; each
+    worker writes a sorted run and the runs are k-way merged into the index.
+    Returns (games, records).
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    jobs = jobs or os.cpu_count() or 1
+    size = os.path.getsize(pgn_path)
+    # Enough ranges to keep every core busy while bounding each worker's memory
+    parts = max(jobs * 4, size // (64 << 20) + 1)
+    ranges = split_game_ranges(pgn_path, parts)
+    run_dir = os.path.dirname(os.path.abspath(index_path))
+
+    tasks = [(pgn_path, start, stop, plies, run_dir) for start, stop in ranges]
+    runs = []
+    try:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            for result in pool.map(_index_range, tasks):
+                runs.append(result)
+                print(f"  ...indexed {sum(r[1] for r in runs)} games")
+
+        games = sum(r[1] for r in runs)
+        records = sum(r[2] for r in runs)
+        with open(index_path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+            f.write(POSITION_INDEX_HEADER.pack(POSITION_INDEX_MAGIC, plies, size, records))
+            pack = POSITION_RECORD.pack
+            for record in heapq.merge(*(_read_run(r[0]) for r in runs)):
+                f.write(pack(*record))
+    finally:
+        for run_path, _, _ in runs:
+            os.remove(run_path)
+
+    return games, records
+
+
+def lookup_position(index_path, fen, pgn_path):
+    """
+    Return the sorted start offsets of all indexed games reaching a FEN position.
+    Raises ValueError if the index was not built from the current pgn_path.
+    """
+    import chess
+    import chess.polyglot
+
+    key = chess.polyglot.zobrist_hash(chess.Board(fen))
+    with open(index_path, "rb") as f:
+        magic, _, source_size, count = POSITION_INDEX_HEADER.unpack(f.read(POSITION_INDEX_HEADER.size))
+        if magic != POSITION_INDEX_MAGIC:
+            raise ValueError(f"{index_path} is not a position index")
+        if source_size != os.path.getsize(pgn_path):
+            raise ValueError(f"position index {index_path} is out of date; "
+                             f"rebuild it with --build-position-index")
+        base = POSITION_INDEX_HEADER.size
+        rsize = POSITION_RECORD.size
+
+        def hash_at(i):
+            f.seek(base + i * rsize)
+            return POSITION_RECORD.unpack(f.read(rsize))[0]
+
+        # Binary search for the first record with this hash
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if hash_at(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        starts = []
+        f.seek(base + lo * rsize)
+        while lo < count:
+            chunk = f.read(rsize * 4096)
+            if not chunk:
+                break
+            for h, start in POSITION_RECORD.iter_unpack(chunk):
+                if h != key:
+                    return starts
+                starts.append(start)
+            lo += len(chunk) // rsize
+    return starts
+
+
+def build_player_index(pgn_path, index_dir):
+    """
+    Build the player index for a PGN file.
+
+    games.bin     one GAME_RECORD per game, in file order
+    postings.bin  uint32 game numbers, grouped by player, ascending per player
+    names.txt     sorted "name<TAB>first posting<TAB>count" lines, one per
+                  normalised White/Black name, binary-searchable on disk
+    Returns (games, players).
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    postings = {}
+    games = 0
+
+    with open(os.path.join(index_dir, "games.bin"), "wb", buffering=WRITE_BUFFER_SIZE) as f_games:
+        for start, end, raw_lines in scan_games(pgn_path):
+            headers = parse_raw_headers(raw_lines)
+            f_games.write(GAME_RECORD.pack(
+                start, end,
+                min(header_elo(headers, "White") or 0, 0xFFFF),
+                min(header_elo(headers, "Black") or 0, 0xFFFF),
+                RESULT_CODES.get(headers.get("Result"), 0),
+            ))
+            for name in {normalise_name(headers.get("White", "")), normalise_name(headers.get("Black", ""))}:
+                if name:
+                    ids = postings.get(name)
+                    if ids is None:
+                        ids = postings[name] = array("I")
+                    ids.append(games)
+            games += 1
+            if games % 100000 == 0:
+                print(f"  ...indexed {games} games ({len(postings)} players)")
+
+    first = 0
+    with open(os.path.join(index_dir, "postings.bin"), "wb", buffering=WRITE_BUFFER_SIZE) as f_post, \
+            open(os.path.join(index_dir, "names.txt"), "w", encoding="utf-8", newline="\n") as f_names:
+        for name in sorted(postings):
+            ids = postings[name]
+            ids.tofile(f_post)
+            f_names.write(f"{name}\t{first}\t{len(ids)}\n")
+            first += len(ids)
+
+    with open(os.path.join(index_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"source_size": os.path.getsize(pgn_path), "games": games}, f)
+    return games, len(postings)
+
+
+def _bisect_names(f, size, key):
+    """Byte offset of the first line in the sorted names file that is >= key."""
+
+    def line_start(pos):
+        # Start of the first line beginning at or after pos
+        if pos == 0:
+            f.seek(0)
+            return 0
+        f.seek(pos - 1)
+        f.readline()
+        return f.tell()
+
+    lo, hi = 0, size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start = line_start(mid)
+        if start >= size or f.readline().split(b"\t", 1)[0] >= key:
+            hi = mid
+        else:
+            lo = mid + 1
+    return line_start(lo)
+
+
+def lookup_player(index_dir, name, prefix=False):
+    """
+    Return {normalised name: sorted game numbers} for players matching `name`
+    exactly, or every player whose normalised name starts with it.
+    """
+    key = normalise_name(name).encode("utf-8")
+    matches = {}
+    names_path = os.path.join(index_dir, "names.txt")
+    with open(names_path, "rb") as f_names, open(os.path.join(index_dir, "postings.bin"), "rb") as f_post:
+        f_names.seek(_bisect_names(f_names, os.path.getsize(names_path), key))
+        for line in f_names:
+            entry, first, count = line.rstrip(b"\n").split(b"\t")
+            if entry != key and not (prefix and entry.startswith(key)):
+                break
+            ids = array("I")
+            f_post.seek(int(first) * ids.itemsize)
+            ids.fromfile(f_post, int(count))
+            matches[entry.decode("utf-8")] = ids
+            if not prefix:
+                break
+    return matches
+
+
+def player_game_spans(index_dir, game_ids):
+    """(start, end) spans of the given game numbers, looked up in games.bin."""
+    with open(os.path.join(index_dir, "games.bin"), "rb") as f:
+        for game_id in game_ids:
+            f.seek(game_id * GAME_RECORD.size)
+            start, end, _, _, _ = GAME_RECORD.unpack(f.read(GAME_RECORD.size))
+            yield start, end
+
+
+def player_index_is_current(pgn_path, index_dir):
+    """True if index_dir holds a player index built from the current pgn_path."""
+    try:
+        with open(os.path.join(index_dir, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+    except OSError:
+        return False
+    return meta["source_size"] == os.path.getsize(pgn_path)
+
+
+def check_player_index(pgn_path, index_dir):
+    """Exit with a message if the player index is missing or stale."""
+    if not os.path.isdir(index_dir):
+        print(f"Error: player index not found: {index_dir} (build it with --build-player-index)")
+        sys.exit(1)
+    if not player_index_is_current(pgn_path, index_dir):
+        print(f"Error: player index {index_dir} is out of date; rebuild it with --build-player-index")
+        sys.exit(1)
+
+
+class EloStats:
+    """
+    Elo-difference and rating-band histograms, filled in batches with NumPy.
+
+    diff_counts[i]        games whose Elo difference falls in bucket i
+    band_outcomes[j, k]   games whose stronger player is in rating band j,
+                          k = 0 win / 1 draw / 2 loss for the stronger player
+                          (equal ratings and unknown results are not counted)
+    """
+
+    def __init__(self, diff_bucket=DEFAULT_DIFF_BUCKET, rating_band=DEFAULT_RATING_BAND):
+        import numpy as np
+
+        self.np = np
+        self.diff_bucket = diff_bucket
+        self.rating_band = rating_band
+        self.diff_counts = np.zeros(MAX_STATS_DIFF // diff_bucket + 1, dtype=np.int64)
+        self.band_outcomes = np.zeros((0xFFFF // rating_band + 1, 3), dtype=np.int64)
+        self.total = 0
+        self.missing_elo = 0
+        self._pending = (array("H"), array("H"), array("B"))
+
+    def add(self, white_elo, black_elo, result_code):
+        """Queue one game; Elo 0 means missing."""
+        w, b, r = self._pending
+        w.append(white_elo)
+        b.append(black_elo)
+        r.append(result_code)
+        if len(w) >= STATS_BATCH_SIZE:
+            self.flush()
+
+    def add_batch(self, white, black, results):
+        """Accumulate NumPy arrays of white Elo, black Elo and result codes."""
+        np = self.np
+        white = white.astype(np.int64)
+        black = black.astype(np.int64)
+        self.total += len(white)
+
+        rated = (white > 0) & (black > 0)
+        self.missing_elo += int(len(white) - np.count_nonzero(rated))
+        white, black, results = white[rated], black[rated], results[rated]
+
+        diff = np.abs(white - black)
+        buckets = np.minimum(diff // self.diff_bucket, len(self.diff_counts) - 1)
+        self.diff_counts += np.bincount(buckets, minlength=len(self.diff_counts))
+
+        white_stronger = white > black
+        black_stronger = black > white
+        stronger = np.maximum(white, black)
+        outcome = np.full(len(white), -1, dtype=np.int64)
+        outcome[results == 3] = 1
+        outcome[(white_stronger & (results == 1)) | (black_stronger & (results == 2))] = 0
+        outcome[(white_stronger & (results == 2)) | (black_stronger & (results == 1))] = 2
+        counted = (outcome >= 0) & (diff > 0)
+        np.add.at(self.band_outcomes, (stronger[counted] // self.rating_band, outcome[counted]), 1)
+
+    def flush(self):
+        w, b, r = self._pending
+        if w:
+            np = self.np
+            self.add_batch(np.frombuffer(w, dtype=np.uint16), np.frombuffer(b, dtype=np.uint16),
+                           np.frombuffer(r, dtype=np.uint8))
+        self._pending = (array("H"), array("H"), array("B"))
+
+    def diff_table(self):
+        """Rows of (bucket label, games, games with at least this difference)."""
+        at_least = self.diff_counts[::-1].cumsum()[::-1]
+        rows = []
+        for i, count in enumerate(self.diff_counts):
+            low = i * self.diff_bucket
+            label = f"{low}+" if i == len(self.diff_counts) - 1 else f"{low}-{low + self.diff_bucket - 1}"
+            rows.append((label, int(count), int(at_least[i])))
+        return rows
+
+    def band_table(self):
+        """Rows of (band label, games, win %, draw %, loss %) for non-empty bands."""
+        rows = []
+        for j, (wins, draws, losses) in enumerate(self.band_outcomes):
+            games = int(wins + draws + losses)
+            if games:
+                low = j * self.rating_band
+                rows.append((f"{low}-{low + self.rating_band - 1}", games,
+                             100 * wins / games, 100 * draws / games, 100 * losses / games))
+        return rows
+
+
+def collect_stats_from_scan(games, stats):
+    """Fill EloStats from (start, end, raw_lines) games."""
+    for count, (_, _, raw_lines) in enumerate(games, 1):
+        headers = parse_raw_headers(raw_lines)
+        stats.add(min(header_elo(headers, "White") or 0, 0xFFFF),
+                  min(header_elo(headers, "Black") or 0, 0xFFFF),
+                  RESULT_CODES.get(headers.get("Result"), 0))
+        if count % 100000 == 0:
+            print(f"  ...processed {count} games so far")
+    stats.flush()
+
+
+def collect_stats_from_index(index_dir, stats):
+    """Fill EloStats straight from the player index's games table."""
+    np = stats.np
+    dtype = np.dtype([("start", "<u8"), ("end", "<u8"), ("white", "<u2"), ("black", "<u2"), ("result", "u1")])
+    assert dtype.itemsize == GAME_RECORD.size
+    table = np.memmap(os.path.join(index_dir, "games.bin"), dtype=dtype, mode="r")
+    for i in range(0, len(table), STATS_BATCH_SIZE):
+        chunk = table[i:i + STATS_BATCH_SIZE]
+        stats.add_batch(chunk["white"], chunk["black"], chunk["result"])
+
+
+def print_stats(stats):
+    rated = stats.total - stats.missing_elo
+    print(f"\n{stats.total} games, {rated} with both ratings ({stats.missing_elo} missing Elo data).")
+
+    print("\nElo difference     games   games with at least this diff")
+    for label, count, at_least in stats.diff_table():
+        share = 100 * at_least / rated if rated else 0
+        print(f"  {label:<12} {count:>10}   {at_least:>10} ({share:5.1f}%)")
+
+    print("\nStronger player    games     win    draw    loss")
+    for label, games, win, draw, loss in stats.band_table():
+        print(f"  {label:<12} {games:>10}  {win:5.1f}%  {draw:5.1f}%  {loss:5.1f}%")
+
+
+def export_stats(stats, path):
+    """Write both tables as JSON."""
+    data = {
+        "games": stats.total,
+        "missing_elo": stats.missing_elo,
+        "diff_bucket": stats.diff_bucket,
+        "rating_band": stats.rating_band,
+        "elo_difference": [
+            {"bucket": label, "games": count, "at_least": at_least}
+            for label, count, at_least in stats.diff_table()
+        ],
+        "stronger_player": [
+            {"band": label, "games": games, "win_pct": round(win, 2), "draw_pct": round(draw, 2),
+             "loss_pct": round(loss, 2)}
+            for label, games, win, draw, loss in stats.band_table()
+        ],
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+
+
+class ShardRouter:
+    """
+    Map a game to a shard path from a template such as
+    "{year}/{speed}_{elo_band}.pgn". Any header tag can be used ({Event},
+    {ECO}); derived fields are year, month, speed, elo_band (average rating,
+    floored to the band width), diff_band, result, and the classified
+    opening_eco, opening and opening_family (the name before any ":").
+    Values are made filename-safe; missing ones, and ones made only of dots
+    (which would leave the shard directory), become "unknown".
+    """
+
+    def __init__(self, template, rating_band=DEFAULT_RATING_BAND):
+        self.template = template
+        self.rating_band = rating_band
+        self.fields = [name for _, name, _, _ in string.Formatter().parse(template) if name]
+        if not self.fields:
+            raise ValueError(f"shard template {template!r} has no {{fields}}")
+
+    def _field(self, game, name):
+        headers = game.headers
+        if name == "year":
+            value = headers.get("Date", "")[:4]
+        elif name == "month":
+            value = headers.get("Date", "")[:7].replace(".", "-")
+        elif name == "speed":
+            value = time_control_speed(headers.get("TimeControl"))
+        elif name == "elo_band":
+            value = None
+            if game.diff is not None:
+                low = (game.white_elo + game.black_elo) // 2 // self.rating_band * self.rating_band
+                value = f"{low}-{low + self.rating_band - 1}"
+        elif name == "diff_band":
+            value = None
+            if game.diff is not None:
+                low = game.diff // self.rating_band * self.rating_band
+                value = f"diff{low}-{low + self.rating_band - 1}"
+        elif name == "result":
+            value = {"1-0": "white", "0-1": "black", "1/2-1/2": "draw"}.get(headers.get("Result"))
+        elif name in ("opening_eco", "opening", "opening_family"):
+            opening = game.opening
+            if opening is None:
+                value = None
+            elif name == "opening_eco":
+                value = opening[0]
+            else:
+                value = opening[1] if name == "opening" else opening[1].split(":")[0]
+        else:
+            value = headers.get(name)
+
+        if not value or "?" in value or not value.strip("."):
+            return "unknown"
+        return UNSAFE_SHARD_CHARS_RE.sub("_", value)
+
+    def path_for(self, game):
+        return self.template.format_map({name: self._field(game, name) for name in self.fields})
+
+
+class ShardWriterPool:
+    """
+    RangeWriters for any number of shard files with a bounded number of open
+    descriptors: the least recently used writer is flushed and closed when
+    the limit is reached, and reopened in append mode if needed again.
+    Buffered bytes are bounded too: past max_buffered in total, the least
+    recently used writers are flushed until half of it is free.
+    """
+
+    def __init__(self, src_fd, src_size, shard_dir, eof_pad=b"", max_open=None,
+                 buffer_size=SHARD_BUFFER_SIZE, max_buffered=SHARD_BUFFER_TOTAL):
+        self.src_fd = src_fd
+        self.src_size = src_size
+        self.shard_dir = shard_dir
+        self.eof_pad = eof_pad
+        self.max_open = max_open or default_max_open_files()
+        self.buffer_size = buffer_size
+        self.max_buffered = max_buffered
+        self.buffered = 0
+        self.writers = OrderedDict()
+        self.counts = {}
+        self.reopens = 0
+
+    def add(self, relpath, start, end):
+        writer = self.writers.get(relpath)
+        if writer is None:
+            writer = self._open(relpath)
+        else:
+            self.writers.move_to_end(relpath)
+        buffered = len(writer.buffer)
+        writer.add(start, end)
+        self.buffered += len(writer.buffer) - buffered
+        self.counts[relpath] += 1
+        if self.buffered > self.max_buffered:
+            self._flush_oldest()
+
+    def _flush_oldest(self):
+        for writer in self.writers.values():
+            self.buffered -= len(writer.buffer)
+            writer.flush()
+            if self.buffered <= self.max_buffered // 2:
+                break
+
+    def _open(self, relpath):
+        if len(self.writers) >= self.max_open:
+            _, oldest = self.writers.popitem(last=False)
+            self.buffered -= len(oldest.buffer)
+            oldest.close()
+        path = os.path.join(self.shard_dir, relpath)
+        seen = relpath in self.counts
+        if seen:
+            self.reopens += 1
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.counts[relpath] = 0
+        writer = RangeWriter(self.src_fd, self.src_size, path, self.eof_pad, self.buffer_size,
+                             append=seen, copy=False)
+        self.writers[relpath] = writer
+        return writer
+
+    def close(self):
+        while self.writers:
+            _, writer = self.writers.popitem()
+            writer.close()
+        self.buffered = 0
+
+
+def default_max_open_files():
+    """Half the soft descriptor limit, leaving room for everything else."""
+    try:
+        import resource
+        soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft == resource.RLIM_INFINITY:
+            soft = 4096
+    except (ImportError, ValueError, OSError):
+        soft = 512
+    return max(soft // 2, 16)
+
+
+def run_sharding(pgn_path, router, shard_dir, dedupe=None, spans=None, max_open=None, classifier=None,
+                 metrics=None):
+    """
+    Route every game to the shard file given by `router`, in one scan.
+    Returns (total, {shard path: game count}, reopen count).
+    """
+    metrics = metrics or ScanMetrics()
+    clock = time.perf_counter
+    src_fd = os.open(pgn_path, os.O_RDONLY)
+    src_size = os.fstat(src_fd).st_size
+    pool = ShardWriterPool(src_fd, src_size, shard_dir, eof_padding(src_fd, src_size), max_open)
+    total = 0
+    try:
+        games = scan_games(pgn_path) if spans is None else read_games_at(pgn_path, spans)
+        t = clock()
+        for start, end, raw_lines in games:
+            now = clock()
+            metrics.read += now - t
+            t = now
+            metrics.games += 1
+            metrics.bytes += end - start
+            metrics.tick(now)
+
+            total += 1
+            headers = parse_raw_headers(raw_lines)
+            if dedupe and dedupe.is_duplicate(game_fingerprint(headers, raw_lines)):
+                now = clock()
+                metrics.parse += now - t
+                t = now
+                continue
+            game = GameInfo(headers, raw_lines, classifier)
+            now = clock()
+            metrics.parse += now - t
+            t = now
+
+            relpath = router.path_for(game)
+            metrics.matched += 1
+            now = clock()
+            metrics.predicate += now - t
+            t = now
+
+            pool.add(relpath, start, end)
+            now = clock()
+            metrics.write += now - t
+            t = now
+    finally:
+        write_started = clock()
+        pool.close()
+        metrics.write += clock() - write_started
+        os.close(src_fd)
+        metrics.finish()
+    return total, pool.counts, pool.reopens
+
+
 def stream_games(pgn_path):
     """Yield one game at a time as a list of lines."""
     current_game = []
@@ -60,12 +1893,312 @@ def stream_games(pgn_path):
         yield current_game
 
 
+def player_spans(pgn_path, args):
+    """
+    Game spans of the --player selection from the player index, or None to
+    scan the whole file. Prints which indexed names matched.
+    """
+    if not args.player:
+        return None
+    index_dir = args.player_index or pgn_path + ".pidx"
+    check_player_index(pgn_path, index_dir)
+    matches = lookup_player(index_dir, args.player, args.player_prefix)
+    if not matches:
+        print(f"No indexed player matches {args.player!r}.")
+    for name, ids in matches.items():
+        print(f"  {name}: {len(ids)} games")
+    game_ids = sorted(set().union(*matches.values())) if len(matches) > 1 else \
+        next(iter(matches.values()), [])
+    return player_game_spans(index_dir, game_ids)
+
+
+def run_player_index_mode(pgn_path, args):
+    index_dir = args.player_index or pgn_path + ".pidx"
+    print("Indexing players...")
+    games, players = build_player_index(pgn_path, index_dir)
+    print(f"\nDone! Indexed {games} games by {players} players into {index_dir}")
+
+
+def apply_sampling(spec, args):
+    """Add the command-line --sample/--stratify/--sort-by settings to a spec that has none."""
+    if args.sample and "sample" not in spec:
+        spec["sample"] = args.sample
+        if args.stratify:
+            spec.setdefault("stratify", args.stratify)
+    if args.sort_by and "sort_by" not in spec:
+        spec["sort_by"] = [field.strip() for field in args.sort_by.split(",") if field.strip()]
+    return spec
+
+
+def make_metrics(args):
+    return ScanMetrics(args.progress_every)
+
+
+def finish_metrics(metrics, args):
+    """Print the final throughput line and write --metrics-json if asked."""
+    metrics.report()
+    if args.metrics_json:
+        metrics.write_json(args.metrics_json)
+        print(f"  Saved throughput summary to {args.metrics_json}")
+
+
+def make_checkpoint(pgn_path, specs, args):
+    """ScanCheckpoint for --checkpoint, or None."""
+    if not args.checkpoint:
+        return None
+    path = pgn_path + ".ckpt.json" if args.checkpoint is True else args.checkpoint
+    return ScanCheckpoint(path, pgn_path, specs, args.checkpoint_every)
+
+
+def make_deduplicator(pgn_path, out_dir, args):
+    """GameDeduplicator sized for the input when --dedupe is given, else None."""
+    if not args.dedupe:
+        return None
+    # ~1 KB per game is typical for headers plus movetext
+    expected_games = os.path.getsize(pgn_path) // 1024 + 1
+    return GameDeduplicator(out_dir, expected_games, args.dedupe_memory)
+
+
+def print_dedupe_summary(dedupe):
+    if dedupe:
+        print(f"  {dedupe.duplicates} duplicate games dropped.")
+
+
+def run_dedupe_mode(pgn_path, args):
+    """Write every distinct game of the input once."""
+    out_dir = os.path.dirname(pgn_path)
+    output = args.output or os.path.join(out_dir, "deduplicated.pgn")
+    dedupe = make_deduplicator(pgn_path, out_dir, args)
+    metrics = make_metrics(args)
+    print("Scanning games...")
+    try:
+        summary = run_filters(pgn_path, [apply_sampling({"name": "unique", "output": output}, args)],
+                              out_dir, dedupe, player_spans(pgn_path, args), args.seed, args.sort_memory,
+                              opening_classifier(args.eco_table), metrics=metrics)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    finally:
+        dedupe.close()
+
+    finish_metrics(metrics, args)
+    print(f"\nDone! Scanned {summary.total} games total.")
+    print_dedupe_summary(dedupe)
+    print(f"  Saved {summary.saved.get('unique', 0)} distinct games to {output}")
+
+
+def run_stats_mode(pgn_path, args):
+    """Print (and optionally export) Elo-difference and outcome statistics."""
+    try:
+        stats = EloStats(args.diff_bucket, args.rating_band)
+    except ImportError:
+        print("Error: --stats needs NumPy (pip install numpy)")
+        sys.exit(1)
+
+    index_dir = args.player_index or pgn_path + ".pidx"
+    if args.player:
+        print("Scanning the player's games...")
+        collect_stats_from_scan(read_games_at(pgn_path, player_spans(pgn_path, args)), stats)
+    elif player_index_is_current(pgn_path, index_dir):
+        print(f"Reading header index {index_dir}...")
+        collect_stats_from_index(index_dir, stats)
+    else:
+        print("Scanning games...")
+        collect_stats_from_scan(scan_games(pgn_path), stats)
+
+    print_stats(stats)
+    if args.stats_export:
+        export_stats(stats, args.stats_export)
+        print(f"\nSaved tables to {args.stats_export}")
+
+
+def run_shard_mode(pgn_path, args):
+    """Split the input into many files keyed by header fields, in one scan."""
+    try:
+        router = ShardRouter(args.shard_by, args.rating_band)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    out_dir = os.path.dirname(pgn_path)
+    shard_dir = args.shard_dir or os.path.join(out_dir, "shards")
+
+    print(f"Sharding by {args.shard_by} into {shard_dir}")
+    print("\nScanning games...")
+    dedupe = make_deduplicator(pgn_path, out_dir, args)
+    metrics = make_metrics(args)
+    try:
+        total, counts, reopens = run_sharding(pgn_path, router, shard_dir, dedupe,
+                                              player_spans(pgn_path, args), args.max_open,
+                                              opening_classifier(args.eco_table), metrics)
+    finally:
+        if dedupe:
+            dedupe.close()
+    finish_metrics(metrics, args)
+
+    print(f"\nDone! Scanned {total} games total.")
+    print_dedupe_summary(dedupe)
+    print(f"  Wrote {sum(counts.values())} games into {len(counts)} shards.")
+    if reopens:
+        print(f"  ({reopens} shard reopens — raise the open-file limit or --max-open to avoid them)")
+    for relpath, count in sorted(counts.items(), key=lambda item: -item[1])[:10]:
+        print(f"  {count:>10}  {relpath}")
+    if len(counts) > 10:
+        print(f"  ... and {len(counts) - 10} more")
+
+
+def run_spec_mode(pgn_path, spec_path, args):
+    """Non-interactive mode: run every spec in the file in one scan."""
+    try:
+        specs = [apply_sampling(spec, args) for spec in load_specs(spec_path)]
+        for spec in specs:
+            compile_spec(spec)  # validate before truncating any output
+    except (OSError, ValueError) as e:
+        print(f"Error: invalid spec file {spec_path}: {e}")
+        sys.exit(1)
+
+    print(f"Running {len(specs)} filter(s) over {pgn_path}")
+    print("\nScanning games...")
+    out_dir = os.path.dirname(pgn_path)
+    dedupe = make_deduplicator(pgn_path, out_dir, args)
+    metrics = make_metrics(args)
+    try:
+        summary = run_filters(pgn_path, specs, out_dir, dedupe, player_spans(pgn_path, args), args.seed,
+                              args.sort_memory, opening_classifier(args.eco_table),
+                              make_checkpoint(pgn_path, specs, args), metrics)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    finally:
+        if dedupe:
+            dedupe.close()
+    finish_metrics(metrics, args)
+
+    print(f"\nDone! Scanned {summary.total} games total.")
+    print_dedupe_summary(dedupe)
+    if summary.skipped_no_elo:
+        print(f"  ({summary.skipped_no_elo} games missing Elo data)")
+    width = max(len(name) for name in summary.matched)
+    for name, count in summary.matched.items():
+        saved = summary.saved.get(name, 0)
+        sampled = f" (sampled {saved})" if saved != count else ""
+        print(f"  {name:<{width}}  {count} games{sampled}")
+
+
+def run_position_index_mode(pgn_path, args):
+    """Build a position index, or extract the games reaching a position."""
+    index_path = args.index or pgn_path + ".zidx"
+
+    if args.build_position_index:
+        print(f"Indexing the first {args.plies} plies of each game...")
+        games, records = build_position_index(pgn_path, index_path, args.plies, args.jobs)
+        print(f"\nDone! Indexed {games} games ({records} positions) into {index_path}")
+
+    if args.position:
+        if not os.path.isfile(index_path):
+            print(f"Error: position index not found: {index_path} (build it with --build-position-index)")
+            sys.exit(1)
+        try:
+            starts = lookup_position(index_path, args.position, pgn_path)
+        except ValueError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        output = args.output or os.path.join(os.path.dirname(pgn_path), "position_games.pgn")
+        count = write_game_ranges(pgn_path, game_spans_at(pgn_path, starts), output)
+        print(f"\n{count} games reach this position.")
+        if count:
+            print(f"  Saved {count} games to {output}")
+
+
 def main():
+    parser = argparse.ArgumentParser(
+        description="Filter PGN games by Elo difference between players.",
+        epilog="Without --specs the filter parameters are asked interactively.",
+    )
+    parser.add_argument("pgn", nargs="?", help="Input PGN file")
+    parser.add_argument("--specs", help="JSON file of named filter specs, all evaluated in one scan")
+    parser.add_argument("-o", "--output", help="Output file for single-output modes")
+    parser.add_argument("--eco-table", action="append", default=[], metavar="TSV",
+                        help="Opening table (lichess chess-openings a.tsv format) used by the opening and "
+                             "opening_eco filters and shard fields; repeatable. A small built-in table "
+                             "is always loaded.")
+
+    parser.add_argument("--dedupe", action="store_true",
+                        help="Drop repeated games (same players, date, round, result and moves); "
+                             "on its own, writes the distinct games to --output")
+    parser.add_argument("--dedupe-memory", type=int, default=DEFAULT_DEDUPE_MEMORY_MB, metavar="MB",
+                        help=f"Bloom filter size for --dedupe (default: {DEFAULT_DEDUPE_MEMORY_MB})")
+
+    parser.add_argument("--progress-every", type=float, default=DEFAULT_PROGRESS_INTERVAL, metavar="SECONDS",
+                        help=f"Seconds between throughput reports (default: {DEFAULT_PROGRESS_INTERVAL})")
+    parser.add_argument("--metrics-json", metavar="PATH",
+                        help="Write a final throughput summary (rates and read/parse/predicate/write "
+                             "time split) as JSON")
+
+    resume = parser.add_argument_group("checkpointing")
+    resume.add_argument("--checkpoint", nargs="?", const=True, metavar="PATH",
+                        help="Save progress periodically and resume an interrupted scan from it "
+                             "(default path: <input>.ckpt.json)")
+    resume.add_argument("--checkpoint-every", type=float, default=DEFAULT_CHECKPOINT_INTERVAL, metavar="SECONDS",
+                        help=f"Seconds between checkpoints (default: {DEFAULT_CHECKPOINT_INTERVAL})")
+
+    sampling = parser.add_argument_group("sampling")
+    sampling.add_argument("--sample", type=int, metavar="K",
+                          help="Keep a uniform random sample of K matching games per output")
+    sampling.add_argument("--stratify", metavar="TAG",
+                          help=f"Balance the sample across values of this header tag, e.g. Result "
+                               f"(at most {MAX_SAMPLE_STRATA} values)")
+    sampling.add_argument("--seed", type=int, help="Random seed for reproducible samples")
+
+    sorting = parser.add_argument_group("sorting")
+    sorting.add_argument("--sort-by", metavar="KEYS",
+                         help="Order each output by comma-separated keys, e.g. '-diff,Date' "
+                              "(diff, white_elo, black_elo, min_elo, max_elo or any header tag)")
+    sorting.add_argument("--sort-memory", type=int, default=DEFAULT_SORT_RUN_RECORDS, metavar="RECORDS",
+                         help=f"Records per in-memory sort run (default: {DEFAULT_SORT_RUN_RECORDS})")
+
+    shards = parser.add_argument_group("sharding")
+    shards.add_argument("--shard-by", metavar="TEMPLATE",
+                        help="Write each game to a file named from its headers, e.g. "
+                             "'{year}/{speed}_{elo_band}.pgn' (fields: any header tag, year, month, "
+                             "speed, elo_band, diff_band, result, opening_eco, opening, opening_family)")
+    shards.add_argument("--shard-dir", help="Shard output directory (default: shards/ next to the input)")
+    shards.add_argument("--max-open", type=int,
+                        help="Maximum shard files kept open (default: half the descriptor limit)")
+
+    stats = parser.add_argument_group("statistics")
+    stats.add_argument("--stats", action="store_true",
+                       help="Show game counts by Elo difference and stronger-player results by rating band "
+                            "(uses the player index when present; needs NumPy)")
+    stats.add_argument("--stats-export", metavar="JSON", help="Also write the --stats tables to this file")
+    stats.add_argument("--diff-bucket", type=int, default=DEFAULT_DIFF_BUCKET,
+                       help=f"Elo difference bucket width (default: {DEFAULT_DIFF_BUCKET})")
+    stats.add_argument("--rating-band", type=int, default=DEFAULT_RATING_BAND,
+                       help=f"Rating band width (default: {DEFAULT_RATING_BAND})")
+
+    players = parser.add_argument_group("player index")
+    players.add_argument("--build-player-index", action="store_true",
+                         help="Build an index of games by player name")
+    players.add_argument("--player", help="Only consider this player's games (needs the player index); "
+                                          "combines with the interactive criteria, --specs and --dedupe")
+    players.add_argument("--player-prefix", action="store_true",
+                         help="Treat --player as a name prefix")
+    players.add_argument("--player-index", help="Player index directory (default: <input>.pidx)")
+
+    position = parser.add_argument_group("position index")
+    position.add_argument("--build-position-index", action="store_true",
+                          help="Build a Zobrist position index of the input")
+    position.add_argument("--position", metavar="FEN", help="Extract every game reaching this position")
+    position.add_argument("--index", help="Position index path (default: <input>.zidx)")
+    position.add_argument("--plies", type=int, default=DEFAULT_INDEX_PLIES,
+                          help=f"Plies indexed per game (default: {DEFAULT_INDEX_PLIES})")
+    position.add_argument("--jobs", type=int, help="Worker processes (default: all cores)")
+    args = parser.parse_args()
+
     print("\n=== PGN Elo Difference Filter ===\n")
 
     # --- Input file ---
-    if len(sys.argv) > 1:
-        pgn_path = sys.argv[1]
+    if args.pgn:
+        pgn_path = args.pgn
     else:
         pgn_path = prompt("Enter path to PGN file (or filename if in current directory)")
     pgn_path = pgn_path.strip("'\"")
@@ -75,15 +2208,34 @@ def main():
         print(f"Error: file not found: {pgn_path}")
         sys.exit(1)
 
+    if args.build_player_index:
+        run_player_index_mode(pgn_path, args)
+        return
+    if args.stats:
+        run_stats_mode(pgn_path, args)
+        return
+    if args.shard_by:
+        run_shard_mode(pgn_path, args)
+        return
+    if args.specs:
+        run_spec_mode(pgn_path, args.specs, args)
+        return
+    if args.build_position_index or args.position:
+        run_position_index_mode(pgn_path, args)
+        return
+    if args.dedupe:
+        run_dedupe_mode(pgn_path, args)
+        return
+
     # --- Parameters ---
     min_diff = int(prompt("Minimum Elo difference", 200))
 
     use_range = prompt("At least one player in a specific Elo range? (y/n)", "y").lower()
-    elo_low = None
-    elo_high = None
+    criteria = {"min_diff": min_diff}
     if use_range == "y":
         elo_low = int(prompt("  Lower bound", 1650))
         elo_high = int(prompt("  Upper bound", 1850))
+        criteria["elo_range"] = [elo_low, elo_high]
 
     # --- Output choice (ask before scanning) ---
     print("\nHow do you want to save?")
@@ -94,74 +2246,34 @@ def main():
 
     out_dir = os.path.dirname(pgn_path)
 
-    # Open output files
-    f_all = None
-    f_strong = None
-    f_weak = None
-
+    # The interactive choices are just a fixed set of specs
+    specs = []
     if choice in ("1", "3"):
-        f_all = open(os.path.join(out_dir, "filtered_all.pgn"), "w", encoding="utf-8")
+        specs.append({"name": "all", "output": "filtered_all.pgn", **criteria})
     if choice in ("2", "3"):
-        f_strong = open(os.path.join(out_dir, "stronger_wins.pgn"), "w", encoding="utf-8")
-        f_weak = open(os.path.join(out_dir, "weaker_wins_or_draws.pgn"), "w", encoding="utf-8")
+        specs.append({"name": "strong", "output": "stronger_wins.pgn",
+                      "outcome": "stronger_wins", **criteria})
+        specs.append({"name": "weak", "output": "weaker_wins_or_draws.pgn",
+                      "outcome": "weaker_wins_or_draws", **criteria})
+
+    specs = [apply_sampling(spec, args) for spec in specs]
 
     # --- Scan and filter ---
     print("\nScanning games...")
-    total = 0
-    matched = 0
-    skipped_no_elo = 0
-    strong_count = 0
-    weak_count = 0
-
-    for game_lines in stream_games(pgn_path):
-        total += 1
-        if total % 100000 == 0:
-            print(f"  ...processed {total} games so far ({matched} matches)")
-
-        w_elo = get_elo(game_lines, "White")
-        b_elo = get_elo(game_lines, "Black")
-
-        if w_elo is None or b_elo is None:
-            skipped_no_elo += 1
-            continue
-
-        diff = abs(w_elo - b_elo)
-        if diff < min_diff:
-            continue
-
-        if elo_low is not None and elo_high is not None:
-            w_in = elo_low <= w_elo <= elo_high
-            b_in = elo_low <= b_elo <= elo_high
-            if not w_in and not b_in:
-                continue
-
-        matched += 1
-        game_text = "".join(game_lines).strip() + "\n\n"
-
-        if f_all:
-            f_all.write(game_text)
-
-        if f_strong or f_weak:
-            result = parse_header(game_lines, "Result")
-            stronger_won = False
-            if w_elo > b_elo and result == "1-0":
-                stronger_won = True
-            elif b_elo > w_elo and result == "0-1":
-                stronger_won = True
-
-            if stronger_won:
-                strong_count += 1
-                if f_strong:
-                    f_strong.write(game_text)
-            else:
-                weak_count += 1
-                if f_weak:
-                    f_weak.write(game_text)
-
-    # Close files
-    for f in (f_all, f_strong, f_weak):
-        if f:
-            f.close()
+    metrics = make_metrics(args)
+    try:
+        summary = run_filters(pgn_path, specs, out_dir, spans=player_spans(pgn_path, args), seed=args.seed,
+                              sort_run_records=args.sort_memory, classifier=opening_classifier(args.eco_table),
+                              checkpoint=make_checkpoint(pgn_path, specs, args), metrics=metrics)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    finish_metrics(metrics, args)
+    total, skipped_no_elo = summary.total, summary.skipped_no_elo
+    strong_count = summary.saved.get("strong", 0)
+    weak_count = summary.saved.get("weak", 0)
+    matched = summary.matched["all"] if "all" in summary.matched else \
+        summary.matched.get("strong", 0) + summary.matched.get("weak", 0)
 
     # --- Summary ---
     print(f"\nDone! Scanned {total} games total.")
@@ -170,7 +2282,7 @@ def main():
     print(f"  {matched} games matched criteria.")
 
     if choice in ("1", "3") and matched:
-        print(f"  Saved {matched} games to filtered_all.pgn")
+        print(f"  Saved {summary.saved['all']} games to filtered_all.pgn")
     if choice in ("2", "3"):
         if strong_count:
             print(f"  Saved {strong_count} games to stronger_wins.pgn")